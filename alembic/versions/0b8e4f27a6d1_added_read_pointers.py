@@ -0,0 +1,37 @@
+"""Added read pointers
+
+Revision ID: 0b8e4f27a6d1
+Revises: f6a1c93d8e52
+Create Date: 2026-10-18 14:55:31.470215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import UUID
+
+
+# revision identifiers, used by Alembic.
+revision = '0b8e4f27a6d1'
+down_revision = 'f6a1c93d8e52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'read_pointers',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column(
+            'user_id', UUID, sa.ForeignKey('users.user_id'), nullable=False
+        ),
+        sa.Column(
+            'station_id', UUID, sa.ForeignKey('stations.station_id'),
+            nullable=False
+        ),
+        sa.Column('last_read_at', sa.DateTime, nullable=True),
+        sa.UniqueConstraint('user_id', 'station_id', name='user_station'),
+    )
+
+
+def downgrade():
+    op.drop_table('read_pointers')
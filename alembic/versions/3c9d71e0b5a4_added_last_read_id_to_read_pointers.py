@@ -0,0 +1,37 @@
+"""Added last read id to read pointers
+
+Revision ID: 3c9d71e0b5a4
+Revises: 0b8e4f27a6d1
+Create Date: 2026-10-18 16:21:07.538412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9d71e0b5a4'
+down_revision = '0b8e4f27a6d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'read_pointers', sa.Column('last_read_id', sa.Integer, nullable=True)
+    )
+    # Existing pointers covered every message sent at last_read_at
+    op.execute("""
+        UPDATE read_pointers
+        SET last_read_id = (
+            SELECT max(station_chats.id)
+            FROM station_chats
+            WHERE station_chats.receiver_id = read_pointers.station_id
+                AND station_chats.sent_at = read_pointers.last_read_at
+        )
+        WHERE last_read_at IS NOT NULL
+    """)
+
+
+def downgrade():
+    op.drop_column('read_pointers', 'last_read_id')
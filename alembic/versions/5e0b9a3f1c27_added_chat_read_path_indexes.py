@@ -0,0 +1,53 @@
+"""Added chat read path indexes
+
+Revision ID: 5e0b9a3f1c27
+Revises: c41d2e8a7b90
+Create Date: 2026-10-18 11:03:17.904512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e0b9a3f1c27'
+down_revision = 'c41d2e8a7b90'
+branch_labels = None
+depends_on = None
+
+
+indexes = [
+    (
+        'ix_private_chats_sender_id_receiver_id_sent_at', 'private_chats',
+        ['sender_id', 'receiver_id', 'sent_at', 'id']
+    ),
+    (
+        'ix_private_chats_receiver_id_sent_at', 'private_chats',
+        ['receiver_id', 'sent_at', 'id']
+    ),
+    (
+        'ix_station_chats_receiver_id_sent_at', 'station_chats',
+        ['receiver_id', 'sent_at', 'id']
+    ),
+    (
+        'ix_subscribers_station_id', 'subscribers',
+        ['station_id']
+    ),
+]
+
+
+def upgrade():
+    # CONCURRENTLY can't run inside a transaction block, end the one
+    # alembic opened so tables stay writable while indexes are built
+    op.execute('COMMIT')
+    for name, table, columns in indexes:
+        op.create_index(
+            name, table, columns,
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    op.execute('COMMIT')
+    for name, table, _ in reversed(indexes):
+        op.drop_index(name, table, postgresql_concurrently=True)
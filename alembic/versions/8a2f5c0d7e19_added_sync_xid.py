@@ -0,0 +1,68 @@
+"""Added sync xid
+
+Revision ID: 8a2f5c0d7e19
+Revises: 3c9d71e0b5a4
+Create Date: 2026-10-18 17:04:52.286731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a2f5c0d7e19'
+down_revision = '3c9d71e0b5a4'
+branch_labels = None
+depends_on = None
+
+
+tables = ['private_chats', 'station_chats', 'unreads']
+
+indexes = [
+    (
+        'ix_private_chats_receiver_id_sync_xid', 'private_chats',
+        ['receiver_id', 'sync_xid', 'id']
+    ),
+    (
+        'ix_private_chats_sender_id_sync_xid', 'private_chats',
+        ['sender_id', 'sync_xid', 'id']
+    ),
+    (
+        'ix_station_chats_receiver_id_sync_xid', 'station_chats',
+        ['receiver_id', 'sync_xid', 'id']
+    ),
+    (
+        'ix_unreads_receiver_id_sync_xid', 'unreads',
+        ['receiver_id', 'sync_xid']
+    ),
+]
+
+
+def upgrade():
+    for table in tables:
+        # Constant default doesn't rewrite the table, existing rows are
+        # older than any client cursor anyway
+        op.add_column(
+            table,
+            sa.Column(
+                'sync_xid', sa.BigInteger, nullable=False,
+                server_default='0'
+            )
+        )
+        op.alter_column(
+            table, 'sync_xid', server_default=sa.text('txid_current()')
+        )
+    op.execute('COMMIT')
+    for name, table, columns in indexes:
+        op.create_index(
+            name, table, columns,
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    op.execute('COMMIT')
+    for name, table, _ in reversed(indexes):
+        op.drop_index(name, table, postgresql_concurrently=True)
+    for table in reversed(tables):
+        op.drop_column(table, 'sync_xid')
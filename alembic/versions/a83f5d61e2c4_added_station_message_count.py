@@ -0,0 +1,35 @@
+"""Added station message count
+
+Revision ID: a83f5d61e2c4
+Revises: 5e0b9a3f1c27
+Create Date: 2026-10-18 11:47:52.337190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83f5d61e2c4'
+down_revision = '5e0b9a3f1c27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'stations',
+        sa.Column(
+            'message_count', sa.Integer, nullable=False, server_default='0'
+        )
+    )
+    op.execute("""
+        UPDATE stations SET message_count = (
+            SELECT count(*) FROM station_chats
+            WHERE station_chats.receiver_id = stations.station_id
+        )
+    """)
+
+
+def downgrade():
+    op.drop_column('stations', 'message_count')
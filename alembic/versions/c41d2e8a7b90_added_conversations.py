@@ -0,0 +1,69 @@
+"""Added conversations
+
+Revision ID: c41d2e8a7b90
+Revises: 9f6c813acf7d
+Create Date: 2026-10-18 10:12:41.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import UUID
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41d2e8a7b90'
+down_revision = '9f6c813acf7d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'conversations',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column(
+            'user_id', UUID, sa.ForeignKey('users.user_id'), nullable=False
+        ),
+        sa.Column(
+            'partner_id', UUID, sa.ForeignKey('users.user_id'),
+            nullable=False
+        ),
+        sa.Column('last_message_id', UUID, nullable=False),
+        sa.Column('last_sent_at', sa.DateTime, nullable=False),
+        sa.Column('count', sa.Integer, nullable=False),
+        sa.UniqueConstraint('user_id', 'partner_id', name='user_partner'),
+    )
+    op.create_index(
+        'ix_conversations_user_id_last_sent_at', 'conversations',
+        ['user_id', 'last_sent_at']
+    )
+    # Backfill one row per (user, partner) from existing private messages
+    op.execute("""
+        INSERT INTO conversations (
+            user_id, partner_id, last_message_id, last_sent_at, count
+        )
+        SELECT
+            user_id,
+            partner_id,
+            (array_agg(message_id ORDER BY sent_at DESC, id DESC))[1],
+            max(sent_at),
+            count(*)
+        FROM (
+            SELECT id, sender_id AS user_id, receiver_id AS partner_id,
+                message_id, sent_at
+            FROM private_chats
+            UNION ALL
+            SELECT id, receiver_id AS user_id, sender_id AS partner_id,
+                message_id, sent_at
+            FROM private_chats
+        ) AS messages
+        WHERE user_id IS NOT NULL
+            AND partner_id IS NOT NULL
+            AND user_id != partner_id
+        GROUP BY user_id, partner_id
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_conversations_user_id_last_sent_at', 'conversations')
+    op.drop_table('conversations')
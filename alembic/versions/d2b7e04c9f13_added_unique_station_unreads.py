@@ -0,0 +1,39 @@
+"""Added unique station unreads
+
+Revision ID: d2b7e04c9f13
+Revises: a83f5d61e2c4
+Create Date: 2026-10-18 13:21:05.662871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2b7e04c9f13'
+down_revision = 'a83f5d61e2c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keep the highest counter of duplicated station rows
+    op.execute("""
+        DELETE FROM unreads
+        WHERE sender_id IS NULL AND id NOT IN (
+            SELECT DISTINCT ON (receiver_id, station_id) id
+            FROM unreads
+            WHERE sender_id IS NULL
+            ORDER BY receiver_id, station_id, count DESC, id
+        )
+    """)
+    op.create_index(
+        'ux_unreads_receiver_id_station_id', 'unreads',
+        ['receiver_id', 'station_id'],
+        unique=True,
+        postgresql_where=sa.text('sender_id IS NULL')
+    )
+
+
+def downgrade():
+    op.drop_index('ux_unreads_receiver_id_station_id', 'unreads')
@@ -0,0 +1,44 @@
+"""Added unique private unreads
+
+Revision ID: f6a1c93d8e52
+Revises: d2b7e04c9f13
+Create Date: 2026-10-18 14:02:48.120934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6a1c93d8e52'
+down_revision = 'd2b7e04c9f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Rows with neither station nor sender were never readable
+    op.execute("""
+        DELETE FROM unreads
+        WHERE station_id IS NULL AND sender_id IS NULL
+    """)
+    # Keep the highest counter of duplicated private rows
+    op.execute("""
+        DELETE FROM unreads
+        WHERE station_id IS NULL AND id NOT IN (
+            SELECT DISTINCT ON (receiver_id, sender_id) id
+            FROM unreads
+            WHERE station_id IS NULL
+            ORDER BY receiver_id, sender_id, count DESC, id
+        )
+    """)
+    op.create_index(
+        'ux_unreads_receiver_id_sender_id', 'unreads',
+        ['receiver_id', 'sender_id'],
+        unique=True,
+        postgresql_where=sa.text('station_id IS NULL')
+    )
+
+
+def downgrade():
+    op.drop_index('ux_unreads_receiver_id_sender_id', 'unreads')
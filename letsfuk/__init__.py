@@ -3,19 +3,21 @@ import ssl
 import logging
 import inject
 from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.options import define
 from tornado.web import Application
 from tornado_sqlalchemy import make_session_factory
 
 from letsfuk import ioc
 from letsfuk.config import Config
-from letsfuk.db import Base
+from letsfuk.db import Base, transaction
+from letsfuk.db.models import Station, Conversation
 from letsfuk.handlers import DefaultHandler
 from letsfuk.handlers.auth import LoginHandler, LogoutHandler
 from letsfuk.handlers.images import ImagesHandler
 from letsfuk.handlers.messages import (
-    MessagesHandler, ChatMessagesHandler, UnreadMessagesHandler
+    MessagesHandler, ChatMessagesHandler, UnreadMessagesHandler,
+    SyncMessagesHandler, BatchMessagesHandler
 )
 from letsfuk.handlers.push_notifications import (
     PushSubscribeHandler, PushUnsubscribeHandler,
@@ -25,7 +27,7 @@ from letsfuk.handlers.stations import (
     StationsHandler, SubscribeHandler,
     StationHandler
 )
-from letsfuk.handlers.status import StatusHandler
+from letsfuk.handlers.status import StatusHandler, MetricsHandler
 from letsfuk.handlers.users import UsersHandler, UserHandler, WhoAmIHandler
 from letsfuk.handlers.websocket import MessageWebSocketHandler
 from letsfuk.logger import (
@@ -57,6 +59,8 @@ def make_app():
         ('/stations/({})/?'.format(uuid_regex), StationHandler),
         ('/stations/subscribe/?', SubscribeHandler),
         ('/messages/?', MessagesHandler),
+        ('/messages/sync/?', SyncMessagesHandler),
+        ('/messages/batch/?', BatchMessagesHandler),
         ('/messages/({})/?'.format(uuid_regex), ChatMessagesHandler),
         ('/messages/unreads/reset/?', UnreadMessagesHandler),
         ('/push-notifications/check/?', PushCheckHandler),
@@ -71,7 +75,19 @@ def make_app():
     ],
         default_handler_class=DefaultHandler,
         session_factory=factory,
-        debug=debug
+        debug=debug,
+        # Tornado pings every socket and closes ones that stop ponging
+        websocket_ping_interval=config.get('websocket_ping_interval', 30),
+        websocket_ping_timeout=config.get('websocket_ping_timeout', 90)
+    )
+
+
+def make_metrics_app():
+    """Internal only application, served on its own port."""
+    return Application([
+        ('/metrics/?', MetricsHandler),
+    ],
+        default_handler_class=DefaultHandler
     )
 
 
@@ -82,6 +98,15 @@ def migrate():
     print("Migration successful!")
 
 
+def repair_counters():
+    inject.configure(ioc.configuration)
+    db = inject.instance('db')
+    with transaction(db):
+        Station.rebuild_message_counts(db)
+        Conversation.rebuild(db)
+    print("Counters repaired!")
+
+
 def main():
     """Construct and serve the tornado application."""
     inject.configure(ioc.configuration)
@@ -100,6 +125,18 @@ def main():
         app,
         ssl_options=ssl_ctx
     )
+    pubsub = inject.instance('pubsub')
+    MessageWebSocketHandler.subscribe(pubsub)
+    pubsub.start()
+    sweep_interval = cfg.get('websocket_sweep_interval', 60)
+    PeriodicCallback(
+        MessageWebSocketHandler.sweep, sweep_interval * 1000
+    ).start()
+    # Queue and socket counts are not for the public, keep them local
+    make_metrics_app().listen(
+        cfg.get('metrics_port', 8889),
+        address=cfg.get('metrics_address', '127.0.0.1')
+    )
     port = cfg.get('port', 8888)
     http_server.listen(port)
     logger.info('Listening on http://localhost:{}'.format(port))
@@ -114,3 +151,5 @@ if args.execute == 'run':
     main()
 elif args.execute == 'migrate':
     migrate()
+elif args.execute == 'repair_counters':
+    repair_counters()
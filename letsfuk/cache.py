@@ -1,4 +1,5 @@
 import json
+import time
 from functools import wraps
 
 
@@ -31,6 +32,25 @@ class Memcache(object):
         json_value = json.dumps(value)
         cls.memcache.set(key, json_value)
 
+    @classmethod
+    @check_memcache()
+    def get_many_dicts(cls, keys):
+        values = cls.memcache.get_many(keys)
+        return {key: json.loads(value) for key, value in values.items()}
+
+    @classmethod
+    @check_memcache()
+    def set_many_dicts(cls, values):
+        json_values = {
+            key: json.dumps(value) for key, value in values.items()
+        }
+        cls.memcache.set_many(json_values)
+
+    @classmethod
+    @check_memcache()
+    def delete(cls, key):
+        cls.memcache.delete(key)
+
     @classmethod
     def get_or_set_dict(cls, key, callback, *args, **kwargs):
         value = cls.get_dict(key)
@@ -38,3 +58,98 @@ class Memcache(object):
             value = callback(*args, **kwargs)
             cls.set_dict(key, value)
         return value
+
+
+class StationMembers(object):
+    """
+    Members of a station as compact (user_id, username, email, avatar_key)
+    tuples. First tier lives in process and expires after ttl seconds so
+    other processes' changes are picked up, second tier is memcache.
+    """
+    fields = ('user_id', 'username', 'email', 'avatar_key')
+    # Will be overridden in ioc from config
+    ttl = 60
+    members = dict()
+
+    @classmethod
+    def key(cls, station_id):
+        return 'station-members-{}'.format(station_id)
+
+    @classmethod
+    def get_or_set(cls, station_id, callback, *args, **kwargs):
+        now = time.monotonic()
+        cached = cls.members.get(station_id)
+        if cached is not None:
+            expires_at, members = cached
+            if now < expires_at:
+                return members
+        members = Memcache.get_or_set_dict(
+            cls.key(station_id), callback, *args, **kwargs
+        )
+        members = [tuple(member) for member in members]
+        cls.members[station_id] = (now + cls.ttl, members)
+        return members
+
+    @classmethod
+    def invalidate(cls, station_id):
+        _ = cls.members.pop(station_id, None)
+        Memcache.delete(cls.key(station_id))
+
+    @classmethod
+    def to_dict(cls, member):
+        return dict(zip(cls.fields, member))
+
+
+class UserProfiles(object):
+    """
+    Rendered user dicts cached under a per-user version. Bumping the
+    version makes every cached copy of the profile stale at once.
+    """
+
+    @classmethod
+    def version_key(cls, user_id):
+        return 'user-version-{}'.format(user_id)
+
+    @classmethod
+    def key(cls, user_id, version):
+        return 'user-{}-v{}'.format(user_id, version)
+
+    @classmethod
+    def get_many(cls, user_ids, callback):
+        version_keys = {
+            user_id: cls.version_key(user_id) for user_id in user_ids
+        }
+        versions = Memcache.get_many_dicts(list(version_keys.values()))
+        if versions is None:
+            return callback(user_ids)
+        keys = {
+            user_id: cls.key(user_id, versions.get(version_key, 0))
+            for user_id, version_key in version_keys.items()
+        }
+        cached = Memcache.get_many_dicts(list(keys.values()))
+        profiles = dict()
+        missing = []
+        for user_id, key in keys.items():
+            profile = cached.get(key)
+            if profile is None:
+                missing.append(user_id)
+            else:
+                profiles[user_id] = profile
+        if len(missing) > 0:
+            loaded = callback(missing)
+            Memcache.set_many_dicts({
+                keys[user_id]: profile for user_id, profile in loaded.items()
+            })
+            profiles.update(loaded)
+        return profiles
+
+    @classmethod
+    def bump(cls, user_id):
+        version_key = cls.version_key(user_id)
+        version = Memcache.get_dict(version_key)
+        if version is None:
+            version = 0
+        # Drop current copy too, in case version key gets evicted and
+        # readers fall back to an older version
+        Memcache.delete(cls.key(user_id, version))
+        Memcache.set_dict(version_key, int(time.time() * 1000))
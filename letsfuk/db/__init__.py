@@ -1,5 +1,9 @@
+from contextlib import contextmanager
+
 from tornado_sqlalchemy import declarative_base
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
 
 Base = declarative_base()
@@ -11,3 +15,49 @@ def commit(db):
     except IntegrityError as e:
         db.rollback()
         raise e
+    run_callbacks(db, 'after_commit')
+    run_callbacks(db, 'after_transaction')
+
+
+@contextmanager
+def transaction(db):
+    """
+    Unit of work, model helpers only flush and everything done inside
+    is committed once, or rolled back if anything raises.
+    """
+    try:
+        yield db
+        commit(db)
+    except Exception as e:
+        db.rollback()
+        raise e
+
+
+def after_commit(db, callback, *args, **kwargs):
+    """
+    Runs callback once current transaction is committed through commit,
+    dropped if it is rolled back.
+    """
+    db.info.setdefault('after_commit', []).append((callback, args, kwargs))
+
+
+def after_transaction(db, callback, *args, **kwargs):
+    """
+    Runs callback once current transaction ends, committed or not.
+    """
+    db.info.setdefault('after_transaction', []).append(
+        (callback, args, kwargs)
+    )
+
+
+def run_callbacks(db, name):
+    # Callbacks may start new transactions, take them off first
+    callbacks = db.info.pop(name, [])
+    for callback, args, kwargs in callbacks:
+        callback(*args, **kwargs)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def on_rollback(session, previous_transaction):
+    _ = session.info.pop('after_commit', None)
+    run_callbacks(session, 'after_transaction')
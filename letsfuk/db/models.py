@@ -1,13 +1,65 @@
 import logging
 
 from sqlalchemy import (
-    Column, UniqueConstraint, DateTime, ForeignKey, Integer, String, Numeric,
-    func, or_, and_, asc, desc
+    Column, UniqueConstraint, Index, DateTime, ForeignKey, Integer, String,
+    Numeric, BigInteger, func, or_, and_, asc, desc, tuple_, case
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import text as raw_sql
+from sqlalchemy.dialects.postgresql import UUID, insert
 from sqlalchemy.ext.hybrid import hybrid_method
 
-from letsfuk.db import commit, Base
+from letsfuk.cache import StationMembers
+from letsfuk.db import Base, after_transaction
+
+
+def paginate(query, model, offset, limit, before=None, after=None):
+    """
+    Page messages newest first. Cursors are (sent_at, id) pairs, when one
+    is given offset is ignored and rows are found through the index.
+    """
+    key = tuple_(model.sent_at, model.id)
+    if after is not None:
+        # Walk forward from the cursor, then flip back to newest first
+        messages = query.filter(key > tuple_(*after)).order_by(
+            asc(model.sent_at), asc(model.id)
+        ).limit(limit).all()
+        return list(reversed(messages))
+    if before is not None:
+        query = query.filter(key < tuple_(*before))
+        offset = 0
+    messages = query.order_by(
+        desc(model.sent_at), desc(model.id)
+    ).offset(offset).limit(limit).all()
+    return messages
+
+
+def sync_xid_column():
+    # Id of the transaction that wrote the row, unlike sent_at it tells
+    # apart rows that were not committed yet when a client synced
+    return Column(
+        BigInteger, nullable=False, server_default=raw_sql('txid_current()')
+    )
+
+
+def get_sync_boundary(db):
+    """
+    Transactions below the boundary are finished, rows they wrote are
+    either visible or never will be.
+    """
+    statement = raw_sql('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+    boundary = db.execute(statement).scalar()
+    return boundary
+
+
+def get_synced(query, model, after, boundary, limit):
+    key = tuple_(model.sync_xid, model.id)
+    query = query.filter(model.sync_xid < boundary)
+    if after is not None:
+        query = query.filter(key > tuple_(*after))
+    rows = query.order_by(
+        asc(model.sync_xid), asc(model.id)
+    ).limit(limit).all()
+    return rows
 
 
 class Station(Base):
@@ -26,6 +78,7 @@ class Station(Base):
         Numeric(10, 6), index=True, nullable=False,
         name='longitude'
     )
+    message_count = Column(Integer, nullable=False, default=0)
 
     @classmethod
     def query_by_station_id(cls, db, station_id):
@@ -41,9 +94,28 @@ class Station(Base):
             _longitude=lon
         )
         db.add(station)
-        commit(db)
+        db.flush()
         return station
 
+    @classmethod
+    def increment_message_count(cls, db, station_id, amount=1):
+        db.query(cls).filter(
+            cls.station_id == station_id
+        ).update(
+            {cls.message_count: cls.message_count + amount},
+            synchronize_session='evaluate'
+        )
+
+    @classmethod
+    def rebuild_message_counts(cls, db):
+        count = db.query(func.count(StationChat.id)).filter(
+            StationChat.receiver_id == cls.station_id
+        ).correlate(cls).as_scalar()
+        db.query(cls).update(
+            {cls.message_count: count},
+            synchronize_session=False
+        )
+
     @hybrid_method
     def distance(self, lat, lon):
         return func.sqrt(
@@ -100,7 +172,7 @@ class User(Base):
             email=email
         )
         db.add(user)
-        commit(db)
+        db.flush()
         return user
 
     @classmethod
@@ -109,6 +181,15 @@ class User(Base):
             cls.user_id == user_id
         ).first()
 
+    @classmethod
+    def query_by_user_ids(cls, db, user_ids):
+        user_ids = [user_id for user_id in user_ids if user_id is not None]
+        if len(user_ids) == 0:
+            return []
+        return db.query(cls).filter(
+            cls.user_id.in_(user_ids)
+        ).all()
+
     @classmethod
     def query_by_username(cls, db, username):
         return db.query(cls).filter(
@@ -131,7 +212,7 @@ class User(Base):
     @classmethod
     def update_avatar(cls, db, user, avatar_key):
         user.avatar_key = avatar_key
-        commit(db)
+        db.flush()
         return user
 
     def to_dict(self):
@@ -165,7 +246,7 @@ class Session(Base):
     @classmethod
     def update_expiring(cls, db, session, expires_at):
         session.expires_at = expires_at
-        commit(db)
+        db.flush()
         return session
 
     @classmethod
@@ -176,13 +257,13 @@ class Session(Base):
             expires_at=expires_at
         )
         db.add(sess)
-        commit(db)
+        db.flush()
         return sess
 
     @classmethod
     def delete(cls, db, session):
         db.delete(session)
-        commit(db)
+        db.flush()
         return session
 
     @classmethod
@@ -213,6 +294,9 @@ class Session(Base):
 
 class Subscriber(Base):
     __tablename__ = 'subscribers'
+    __table_args__ = (
+        Index('ix_subscribers_station_id', 'station_id'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     station_id = Column(
@@ -234,13 +318,40 @@ class Subscriber(Base):
         return subscriber
 
     @classmethod
-    def get_users_for_station(cls, db, station_id):
-        user_ids_tuple = db.query(cls.user_id).filter(
+    def query_members_for_station(cls, db, station_id):
+        members = db.query(
+            User.user_id, User.username, User.email, User.avatar_key
+        ).join(
+            cls, cls.user_id == User.user_id
+        ).filter(
             cls.station_id == station_id
         ).all()
-        user_ids = [user_id_tuple[0] for user_id_tuple in user_ids_tuple]
-        users = db.query(User).filter(User.user_id.in_(user_ids))
-        return users
+        return [list(member) for member in members]
+
+    @classmethod
+    def get_members_for_station(cls, db, station_id):
+        """
+        Cached, other processes may serve an old list until it expires.
+        Only for display, writes take members from get_member_ids.
+        """
+        members = StationMembers.get_or_set(
+            station_id, cls.query_members_for_station, db, station_id
+        )
+        return members
+
+    @classmethod
+    def get_member_ids(cls, db, station_id):
+        member_ids = db.query(cls.user_id).filter(
+            cls.station_id == station_id
+        ).all()
+        return [user_id for user_id, in member_ids]
+
+    @classmethod
+    def count_members(cls, db, station_id):
+        count = db.query(cls).filter(
+            cls.station_id == station_id
+        ).count()
+        return count
 
     @classmethod
     def get_station_for_user(cls, db, user_id):
@@ -259,15 +370,25 @@ class Subscriber(Base):
             user_id=user_id
         )
         db.add(subscriber)
-        commit(db)
+        db.flush()
+        cls.invalidate_members(db, station_id)
         return subscriber
 
     @classmethod
     def delete(cls, db, subscriber):
+        station_id = subscriber.station_id
         db.delete(subscriber)
-        commit(db)
+        db.flush()
+        cls.invalidate_members(db, station_id)
         return subscriber
 
+    @classmethod
+    def invalidate_members(cls, db, station_id):
+        # Now for reads later in this request, and again once transaction
+        # ends, other processes may have cached rows from before it
+        StationMembers.invalidate(station_id)
+        after_transaction(db, StationMembers.invalidate, station_id)
+
     def to_dict(self):
         return {
             "station_id": self.station_id,
@@ -284,6 +405,24 @@ class Subscriber(Base):
 
 class PrivateChat(Base):
     __tablename__ = 'private_chats'
+    __table_args__ = (
+        Index(
+            'ix_private_chats_sender_id_receiver_id_sent_at',
+            'sender_id', 'receiver_id', 'sent_at', 'id'
+        ),
+        Index(
+            'ix_private_chats_receiver_id_sent_at',
+            'receiver_id', 'sent_at', 'id'
+        ),
+        Index(
+            'ix_private_chats_receiver_id_sync_xid',
+            'receiver_id', 'sync_xid', 'id'
+        ),
+        Index(
+            'ix_private_chats_sender_id_sync_xid',
+            'sender_id', 'sync_xid', 'id'
+        ),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     message_id = Column(UUID, index=True, nullable=False, unique=True)
@@ -296,6 +435,7 @@ class PrivateChat(Base):
     sent_at = Column(DateTime, nullable=False)
     text = Column(String(600), nullable=True)
     image_key = Column(String, nullable=True)
+    sync_xid = sync_xid_column()
 
     @classmethod
     def add(
@@ -311,12 +451,15 @@ class PrivateChat(Base):
             sent_at=sent_at
         )
         db.add(message)
-        commit(db)
+        db.flush()
         return message
 
     @classmethod
-    def get(cls, db, receiver_id, sender_id, offset, limit):
-        private_chat = db.query(cls).filter(
+    def get(
+        cls, db, receiver_id, sender_id, offset, limit,
+        before=None, after=None
+    ):
+        query = db.query(cls).filter(
             or_(
                 and_(
                     cls.receiver_id == receiver_id,
@@ -327,9 +470,61 @@ class PrivateChat(Base):
                     cls.sender_id == receiver_id,
                     ),
             )
-        ).order_by(desc(cls.sent_at)).offset(offset).limit(limit).all()
+        )
+        private_chat = paginate(query, cls, offset, limit, before, after)
         return private_chat
 
+    @classmethod
+    def get_since(cls, db, user_id, after, boundary, limit):
+        query = db.query(cls).filter(
+            or_(
+                cls.receiver_id == user_id,
+                cls.sender_id == user_id,
+                )
+        )
+        messages = get_synced(query, cls, after, boundary, limit)
+        return messages
+
+    @classmethod
+    def get_latest_for_partners(cls, db, user_id, partner_ids, limit):
+        chats = {partner_id: [] for partner_id in partner_ids}
+        if len(chats) == 0:
+            return chats
+        partner_id = case(
+            [(cls.sender_id == user_id, cls.receiver_id)],
+            else_=cls.sender_id
+        )
+        row_number = func.row_number().over(
+            partition_by=partner_id,
+            order_by=(desc(cls.sent_at), desc(cls.id))
+        )
+        latest = db.query(
+            cls.id.label('id'),
+            partner_id.label('partner_id'),
+            row_number.label('row_number')
+        ).filter(
+            or_(
+                and_(
+                    cls.sender_id == user_id,
+                    cls.receiver_id.in_(partner_ids),
+                    ),
+                and_(
+                    cls.receiver_id == user_id,
+                    cls.sender_id.in_(partner_ids),
+                    ),
+            )
+        ).subquery()
+        messages = db.query(cls, latest.c.partner_id).join(
+            latest, cls.id == latest.c.id
+        ).filter(
+            latest.c.row_number <= limit
+        ).order_by(
+            latest.c.partner_id, desc(cls.sent_at), desc(cls.id)
+        ).all()
+        for message, message_partner_id in messages:
+            chats[message_partner_id].append(message)
+        return chats
+
     @classmethod
     def get_total(cls, db, receiver_id, sender_id):
         total = db.query(cls).filter(
@@ -346,49 +541,6 @@ class PrivateChat(Base):
         ).count()
         return total
 
-    @classmethod
-    def get_total_chats(cls, db, user_id):
-        user_ids_tuple = db.query(cls.receiver_id, cls.sender_id).filter(
-            or_(
-                cls.receiver_id == user_id,
-                cls.sender_id == user_id,
-                )
-        ).all()
-        user_ids = []
-        for receiver_id, sender_id in user_ids_tuple:
-            if receiver_id != user_id:
-                if receiver_id not in user_ids:
-                    user_ids.append(receiver_id)
-            elif sender_id != user_id:
-                if sender_id not in user_ids:
-                    user_ids.append(sender_id)
-        return len(user_ids)
-
-    @classmethod
-    def get_user_ids_for_user_id(cls, db, user_id, offset, limit):
-        user_ids_tuple = db.query(cls.receiver_id, cls.sender_id).filter(
-            or_(
-                cls.receiver_id == user_id,
-                cls.sender_id == user_id,
-                )
-        ).order_by(desc(cls.sent_at)).all()
-        user_ids = []
-        for receiver_id, sender_id in user_ids_tuple:
-            if receiver_id != user_id:
-                if receiver_id not in user_ids:
-                    user_ids.append(receiver_id)
-            elif sender_id != user_id:
-                if sender_id not in user_ids:
-                    user_ids.append(sender_id)
-        end = limit + offset
-        if end > len(user_ids):
-            end = len(user_ids)
-        if offset >= len(user_ids):
-            user_ids = []
-        else:
-            user_ids = user_ids[offset:end]
-        return user_ids
-
     def to_dict(self):
         return {
             "message_id": self.message_id,
@@ -409,8 +561,147 @@ class PrivateChat(Base):
         )
 
 
+class Conversation(Base):
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'partner_id', name='user_partner'),
+        Index(
+            'ix_conversations_user_id_last_sent_at',
+            'user_id', 'last_sent_at'
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(
+        UUID, ForeignKey('users.user_id'), nullable=False
+    )
+    partner_id = Column(
+        UUID, ForeignKey('users.user_id'), nullable=False
+    )
+    last_message_id = Column(UUID, nullable=False)
+    last_sent_at = Column(DateTime, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def get(cls, db, user_id, partner_id):
+        # Counters are changed by plain statements, refresh loaded rows
+        conversation = db.query(cls).populate_existing().filter(
+            cls.user_id == user_id,
+            cls.partner_id == partner_id
+        ).first()
+        return conversation
+
+    @classmethod
+    def add_message(cls, db, message):
+        # Messages to yourself are not listed as a chat
+        if message.sender_id == message.receiver_id:
+            return None
+        # Both sides of the chat get their own row, one statement bumps
+        # both and rows are locked in the same order by every sender
+        user_ids = sorted([message.sender_id, message.receiver_id])
+        statement = insert(cls.__table__).values([
+            {
+                "user_id": user_id,
+                "partner_id": partner_id,
+                "last_message_id": message.message_id,
+                "last_sent_at": message.sent_at,
+                "count": 1
+            }
+            for user_id, partner_id in [user_ids, user_ids[::-1]]
+        ])
+        # Message sent earlier but committed later doesn't become last
+        is_latest = statement.excluded.last_sent_at >= cls.last_sent_at
+        statement = statement.on_conflict_do_update(
+            constraint='user_partner',
+            set_={
+                'count': cls.count + 1,
+                'last_message_id': case(
+                    [(is_latest, statement.excluded.last_message_id)],
+                    else_=cls.last_message_id
+                ),
+                'last_sent_at': func.greatest(
+                    cls.last_sent_at, statement.excluded.last_sent_at
+                )
+            }
+        )
+        db.execute(statement)
+        return cls.get(db, message.sender_id, message.receiver_id)
+
+    @classmethod
+    def rebuild(cls, db):
+        db.query(cls).delete(synchronize_session=False)
+        db.execute(raw_sql("""
+            INSERT INTO conversations (
+                user_id, partner_id, last_message_id, last_sent_at, count
+            )
+            SELECT
+                user_id,
+                partner_id,
+                (array_agg(message_id ORDER BY sent_at DESC, id DESC))[1],
+                max(sent_at),
+                count(*)
+            FROM (
+                SELECT id, sender_id AS user_id, receiver_id AS partner_id,
+                    message_id, sent_at
+                FROM private_chats
+                UNION ALL
+                SELECT id, receiver_id AS user_id, sender_id AS partner_id,
+                    message_id, sent_at
+                FROM private_chats
+            ) AS messages
+            WHERE user_id IS NOT NULL
+                AND partner_id IS NOT NULL
+                AND user_id != partner_id
+            GROUP BY user_id, partner_id
+        """))
+
+    @classmethod
+    def get_partner_ids(cls, db, user_id, offset, limit):
+        partner_ids_tuple = db.query(cls.partner_id).filter(
+            cls.user_id == user_id
+        ).order_by(
+            desc(cls.last_sent_at)
+        ).offset(offset).limit(limit).all()
+        return [partner_id for partner_id, in partner_ids_tuple]
+
+    @classmethod
+    def get_total(cls, db, user_id):
+        total = db.query(cls).filter(
+            cls.user_id == user_id
+        ).count()
+        return total
+
+    def to_dict(self):
+        return {
+            "user_id": self.user_id,
+            "partner_id": self.partner_id,
+            "last_message_id": self.last_message_id,
+            "last_sent_at": str(self.last_sent_at),
+            "count": self.count
+        }
+
+    def __repr__(self):
+        return (
+            '<id: {} user_id: {} partner_id: {} last_message_id: {} '
+            'count: {}>'.format(
+                self.id, self.user_id, self.partner_id,
+                self.last_message_id, self.count
+            )
+        )
+
+
 class StationChat(Base):
     __tablename__ = 'station_chats'
+    __table_args__ = (
+        Index(
+            'ix_station_chats_receiver_id_sent_at',
+            'receiver_id', 'sent_at', 'id'
+        ),
+        Index(
+            'ix_station_chats_receiver_id_sync_xid',
+            'receiver_id', 'sync_xid', 'id'
+        ),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     message_id = Column(UUID, index=True, nullable=False, unique=True)
@@ -423,6 +714,7 @@ class StationChat(Base):
     sent_at = Column(DateTime, nullable=False)
     text = Column(String(600), nullable=True)
     image_key = Column(String, nullable=True)
+    sync_xid = sync_xid_column()
 
     @classmethod
     def add(
@@ -438,14 +730,23 @@ class StationChat(Base):
             sent_at=sent_at
         )
         db.add(message)
-        commit(db)
+        db.flush()
         return message
 
     @classmethod
-    def get(cls, db, receiver_id, offset, limit):
-        messages = db.query(cls).filter(
+    def get(cls, db, receiver_id, offset, limit, before=None, after=None):
+        query = db.query(cls).filter(
             cls.receiver_id == receiver_id
-        ).order_by(desc(cls.sent_at)).offset(offset).limit(limit).all()
+        )
+        messages = paginate(query, cls, offset, limit, before, after)
+        return messages
+
+    @classmethod
+    def get_since(cls, db, receiver_id, after, boundary, limit):
+        query = db.query(cls).filter(
+            cls.receiver_id == receiver_id
+        )
+        messages = get_synced(query, cls, after, boundary, limit)
         return messages
 
     @classmethod
@@ -477,6 +778,23 @@ class StationChat(Base):
 
 class Unread(Base):
     __tablename__ = 'unreads'
+    __table_args__ = (
+        # Station counters have no sender, NULLs never conflict in a plain
+        # unique constraint so uniqueness is enforced by partial index
+        Index(
+            'ux_unreads_receiver_id_station_id',
+            'receiver_id', 'station_id',
+            unique=True,
+            postgresql_where=raw_sql('sender_id IS NULL')
+        ),
+        Index(
+            'ux_unreads_receiver_id_sender_id',
+            'receiver_id', 'sender_id',
+            unique=True,
+            postgresql_where=raw_sql('station_id IS NULL')
+        ),
+        Index('ix_unreads_receiver_id_sync_xid', 'receiver_id', 'sync_xid'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     receiver_id = Column(UUID, nullable=False)
@@ -487,40 +805,144 @@ class Unread(Base):
         UUID, ForeignKey('users.user_id'), nullable=True
     )
     count = Column(Integer, nullable=False, default=0)
+    # Counters are rewritten in place, every write moves the row forward
+    sync_xid = sync_xid_column()
 
     @classmethod
     def add(cls, db, receiver_id, station_id=None, sender_id=None):
+        count = cls.increment(db, receiver_id, station_id, sender_id)
+        if count is None:
+            return None
+        return cls.get(db, receiver_id, station_id, sender_id)
+
+    @classmethod
+    def increment(
+        cls, db, receiver_id, station_id=None, sender_id=None, amount=1
+    ):
         if station_id is None and sender_id is None:
             return None
-        unread = cls.get(db, receiver_id, station_id, sender_id)
-        if unread is None:
-            unread = Unread(
-                receiver_id=receiver_id,
-                station_id=station_id,
-                sender_id=sender_id,
-                count=0
+        if sender_id is None:
+            counts = cls.add_for_station(
+                db, station_id, [receiver_id], amount
             )
-            db.add(unread)
-        unread.count += 1
-        commit(db)
-        return unread
+            return counts[receiver_id]
+        statement = insert(cls.__table__).values(
+            receiver_id=receiver_id,
+            station_id=None,
+            sender_id=sender_id,
+            count=amount
+        ).on_conflict_do_update(
+            index_elements=['receiver_id', 'sender_id'],
+            index_where=cls.station_id.is_(None),
+            set_={
+                'count': cls.count + amount,
+                'sync_xid': func.txid_current()
+            }
+        ).returning(cls.count)
+        count = db.execute(statement).scalar()
+        return count
+
+    @classmethod
+    def add_for_station(cls, db, station_id, receiver_ids, amount=1):
+        # Rows are locked in insert order, same order everywhere avoids
+        # deadlocks between concurrent posts to the station
+        receiver_ids = sorted(receiver_ids)
+        if len(receiver_ids) == 0:
+            return dict()
+        statement = insert(cls.__table__).values([
+            {
+                "receiver_id": receiver_id,
+                "station_id": station_id,
+                "sender_id": None,
+                "count": amount
+            }
+            for receiver_id in receiver_ids
+        ]).on_conflict_do_update(
+            index_elements=['receiver_id', 'station_id'],
+            index_where=cls.sender_id.is_(None),
+            set_={
+                'count': cls.count + amount,
+                'sync_xid': func.txid_current()
+            }
+        ).returning(cls.receiver_id, cls.count)
+        counts = db.execute(statement).fetchall()
+        return {receiver_id: count for receiver_id, count in counts}
+
+    @classmethod
+    def set_for_station(cls, db, station_id, counts):
+        receiver_ids = sorted(counts)
+        if len(receiver_ids) == 0:
+            return
+        statement = insert(cls.__table__).values([
+            {
+                "receiver_id": receiver_id,
+                "station_id": station_id,
+                "sender_id": None,
+                "count": counts[receiver_id]
+            }
+            for receiver_id in receiver_ids
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=['receiver_id', 'station_id'],
+            index_where=cls.sender_id.is_(None),
+            set_={
+                'count': statement.excluded.count,
+                'sync_xid': func.txid_current()
+            }
+        )
+        db.execute(statement)
 
     @classmethod
     def get(cls, db, receiver_id, station_id=None, sender_id=None):
-        unread = db.query(cls).filter(
+        # Counters are changed by plain statements, refresh loaded rows
+        unread = db.query(cls).populate_existing().filter(
             cls.receiver_id == receiver_id,
             cls.station_id == station_id,
             cls.sender_id == sender_id
         ).first()
         return unread
 
+    @classmethod
+    def get_for_user(cls, db, receiver_id, station_id=None, sender_ids=()):
+        sender_ids = list(sender_ids)
+        unreads = db.query(cls).populate_existing().filter(
+            cls.receiver_id == receiver_id,
+            or_(
+                and_(
+                    cls.station_id == station_id,
+                    cls.sender_id.is_(None),
+                    ),
+                and_(
+                    cls.station_id.is_(None),
+                    cls.sender_id.in_(sender_ids),
+                    ),
+            )
+        ).all()
+        return unreads
+
+    @classmethod
+    def get_private_since(cls, db, receiver_id, after, boundary):
+        unreads = db.query(cls).filter(
+            cls.receiver_id == receiver_id,
+            cls.station_id.is_(None),
+            cls.sync_xid >= after,
+            cls.sync_xid < boundary
+        ).all()
+        return unreads
+
     @classmethod
     def reset(cls, db, receiver_id, station_id=None, sender_id=None, count=0):
+        db.query(cls).filter(
+            cls.receiver_id == receiver_id,
+            cls.station_id == station_id,
+            cls.sender_id == sender_id
+        ).update(
+            {cls.count: count, cls.sync_xid: func.txid_current()},
+            synchronize_session=False
+        )
         unread = cls.get(db, receiver_id, station_id, sender_id)
         if unread is None:
             return Unread()
-        unread.count = count
-        commit(db)
         return unread
 
     def to_dict(self):
@@ -539,6 +961,147 @@ class Unread(Base):
         )
 
 
+class ReadPointer(Base):
+    __tablename__ = 'read_pointers'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'station_id', name='user_station'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(
+        UUID, ForeignKey('users.user_id'), nullable=False
+    )
+    station_id = Column(
+        UUID, ForeignKey('stations.station_id'), nullable=False
+    )
+    # Everything sent after (last_read_at, last_read_id) is unread,
+    # NULL means nothing was read
+    last_read_at = Column(DateTime, nullable=True)
+    last_read_id = Column(Integer, nullable=True)
+
+    @classmethod
+    def get(cls, db, user_id, station_id):
+        pointer = db.query(cls).populate_existing().filter(
+            cls.user_id == user_id,
+            cls.station_id == station_id
+        ).first()
+        return pointer
+
+    @classmethod
+    def get_for_users(cls, db, station_id, user_ids):
+        user_ids = list(user_ids)
+        if len(user_ids) == 0:
+            return dict()
+        pointers = db.query(
+            cls.user_id, cls.last_read_at, cls.last_read_id
+        ).filter(
+            cls.station_id == station_id,
+            cls.user_id.in_(user_ids)
+        ).all()
+        return {
+            user_id: (last_read_at, last_read_id)
+            for user_id, last_read_at, last_read_id in pointers
+            if last_read_at is not None
+        }
+
+    @classmethod
+    def move(cls, db, user_id, station_id, last_read_at, last_read_id):
+        statement = insert(cls.__table__).values(
+            user_id=user_id,
+            station_id=station_id,
+            last_read_at=last_read_at,
+            last_read_id=last_read_id
+        ).on_conflict_do_update(
+            constraint='user_station',
+            set_={
+                'last_read_at': last_read_at,
+                'last_read_id': last_read_id
+            }
+        )
+        db.execute(statement)
+
+    @classmethod
+    def move_to_unread(cls, db, user_id, station_id, count):
+        # Newest message that stays read is the one right after
+        # the last `count` unread ones
+        messages = StationChat.get(db, station_id, max(count, 0), 1)
+        last_read_at = None
+        last_read_id = None
+        if len(messages) > 0:
+            last_read_at = messages[0].sent_at
+            last_read_id = messages[0].id
+        cls.move(db, user_id, station_id, last_read_at, last_read_id)
+
+    @classmethod
+    def count_unread(cls, db, user_id, station_id, cap):
+        pointer = cls.get(db, user_id, station_id)
+        # Own messages are never unread, same as station counters
+        query = db.query(StationChat.id).filter(
+            StationChat.receiver_id == station_id,
+            or_(
+                StationChat.sender_id.is_(None),
+                StationChat.sender_id != user_id
+            )
+        )
+        if pointer is not None and pointer.last_read_at is not None:
+            # Same key messages are paged by, so equal sent_at is no issue
+            query = query.filter(
+                tuple_(StationChat.sent_at, StationChat.id) >
+                tuple_(pointer.last_read_at, pointer.last_read_id)
+            )
+        # Stop counting at cap, rows are walked through the station index
+        unread = query.limit(cap).subquery()
+        count = db.query(func.count()).select_from(unread).scalar()
+        return count
+
+    @classmethod
+    def count_unread_for_users(cls, db, station_id, user_ids, cap):
+        """
+        Capped unread counts for many members with two queries, only
+        the newest `cap` messages can be unread as far as anyone sees.
+        """
+        newest = db.query(
+            StationChat.sent_at, StationChat.id, StationChat.sender_id
+        ).filter(
+            StationChat.receiver_id == station_id
+        ).order_by(
+            desc(StationChat.sent_at), desc(StationChat.id)
+        ).limit(cap).all()
+        pointers = cls.get_for_users(db, station_id, user_ids)
+        counts = dict()
+        for user_id in user_ids:
+            pointer = pointers.get(user_id)
+            count = 0
+            reached_pointer = False
+            for sent_at, message_id, sender_id in newest:
+                if pointer is not None and (sent_at, message_id) <= pointer:
+                    reached_pointer = True
+                    break
+                if sender_id != user_id:
+                    count += 1
+            if count < cap and not reached_pointer and len(newest) == cap:
+                # Own messages took some of the newest rows, older ones
+                # may still be unread
+                count = cls.count_unread(db, user_id, station_id, cap)
+            counts[user_id] = count
+        return counts
+
+    def to_dict(self):
+        return {
+            "user_id": self.user_id,
+            "station_id": self.station_id,
+            "last_read_at": str(self.last_read_at),
+            "last_read_id": self.last_read_id,
+        }
+
+    def __repr__(self):
+        return (
+            '<id: {} user_id: {} station_id: {} last_read_at: {}>'.format(
+                self.id, self.user_id, self.station_id, self.last_read_at
+            )
+        )
+
+
 class PushNotification(Base):
     __tablename__ = 'push_notifications'
     __table_args__ = (
@@ -566,13 +1129,13 @@ class PushNotification(Base):
         else:
             # Update new user to use this device_browser
             subscriber.user_id = user_id
-        commit(db)
+        db.flush()
         return subscriber
 
     @classmethod
     def unsubscribe(cls, db, subscriber):
         db.delete(subscriber)
-        commit(db)
+        db.flush()
         return subscriber
 
     @classmethod
@@ -601,6 +1164,16 @@ class PushNotification(Base):
         ).all()
         return device_browsers
 
+    @classmethod
+    def query_by_user_ids(cls, db, user_ids):
+        user_ids = list(user_ids)
+        if len(user_ids) == 0:
+            return []
+        device_browsers = db.query(cls).filter(
+            cls.user_id.in_(user_ids)
+        ).all()
+        return device_browsers
+
     def to_dict(self):
         return {
             "user_id": self.user_id,
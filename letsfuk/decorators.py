@@ -6,6 +6,7 @@ from functools import wraps
 from json import JSONDecodeError
 from sqlalchemy.exc import IntegrityError
 from letsfuk.config import Config
+from letsfuk.db import commit, transaction
 from letsfuk.db.models import Session
 from letsfuk.models.user import User
 from letsfuk.errors import HttpException, InternalError, Unauthorized
@@ -22,6 +23,7 @@ def endpoint_wrapper(**kwargs):
     def dec(func):
         @wraps(func)
         def wrapper(self, *args, **kw):
+            db = inject.instance('db')
             try:
                 self.request.params = dict()
                 for param in self.request.arguments:
@@ -30,7 +32,9 @@ def endpoint_wrapper(**kwargs):
                     bytes_param = self.request.arguments[param][0]
                     str_param = bytes_param.decode(encoding)
                     self.request.params[param] = str_param
-                response, status_code = func(self, *args, **kw)
+                # Whole request is one transaction, committed once
+                with transaction(db):
+                    response, status_code = func(self, *args, **kw)
             except HttpException as e:
                 response = {
                     "status_code": e.status_code,
@@ -49,6 +53,7 @@ def image_endpoint_wrapper(**kwargs):
     def dec(func):
         @wraps(func)
         def wrapper(self, *args, **kw):
+            db = inject.instance('db')
             try:
                 self.request.params = dict()
                 for param in self.request.arguments:
@@ -57,7 +62,8 @@ def image_endpoint_wrapper(**kwargs):
                     bytes_param = self.request.arguments[param][0]
                     str_param = bytes_param.decode(encoding)
                     self.request.params[param] = str_param
-                data, status_code = func(self, *args, **kw)
+                with transaction(db):
+                    data, status_code = func(self, *args, **kw)
             except HttpException as e:
                 response = {
                     "status_code": e.status_code,
@@ -141,8 +147,9 @@ def check_session(**kwargs):
                     )
                 # session is expired
                 else:
-                    # logout logic
+                    # logout logic, commit now since raising rolls back
                     Session.delete(db, existing_session)
+                    commit(db)
                     raise Unauthorized("Your session is expired")
                 self.request.session = existing_session
                 return func(self, *args, **kw)
@@ -0,0 +1,246 @@
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+import inject
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue, QueueFull
+
+from letsfuk.config import Config
+from letsfuk.db import transaction
+from letsfuk.handlers.websocket import MessageWebSocketHandler
+from letsfuk.models.push_notifications import PushCoalescer
+
+logger = logging.getLogger(__name__)
+
+
+class Delivery(object):
+    def __init__(
+            self, user_id, event, data, push, frame=None, coalesce_key=None
+    ):
+        self.user_id = user_id
+        self.event = event
+        # With a shared frame data only holds this recipient's fields
+        self.data = data
+        self.push = push
+        self.frame = frame
+        self.coalesce_key = coalesce_key
+        self.enqueued_at = time.monotonic()
+
+    def get_data(self):
+        if self.frame is not None:
+            return self.frame.to_dict(self.data)
+        return self.data
+
+    def render(self, data):
+        if self.frame is not None:
+            return self.frame.render(data)
+        return json.dumps({"event": self.event, "data": data})
+
+    def send(self, data, delivery_id=None):
+        """
+        Returns whether any device connected to this process got it.
+        """
+        return MessageWebSocketHandler.send_local(
+            self.user_id, self.render(data), self.coalesce_key, delivery_id
+        )
+
+
+class DeliveryQueue(object):
+    """
+    Websocket and push deliveries are queued and sent from the IOLoop
+    after the request that produced them has been answered.
+    """
+    queue = None
+    io_loop = None
+    enqueued = 0
+    delivered = 0
+    overflowed = 0
+    pushed = 0
+    cross_process_ack_timeout = 2
+    push_skipped = 0
+    lag = 0.0
+    max_lag = 0.0
+
+    @classmethod
+    def get_queue(cls):
+        io_loop = IOLoop.current()
+        # Worker belongs to the loop that started it, tests get new loops
+        if cls.io_loop is not io_loop:
+            config = inject.instance(Config)
+            cls.queue = Queue(
+                maxsize=config.get('delivery_queue_size', 10000)
+            )
+            cls.io_loop = io_loop
+            io_loop.spawn_callback(cls.work, cls.queue)
+        return cls.queue
+
+    @classmethod
+    def enqueue(
+            cls, user_id, event='message', data=None, push=False,
+            frame=None, coalesce_key=None
+    ):
+        delivery = Delivery(user_id, event, data, push, frame, coalesce_key)
+        cls.enqueued += 1
+        try:
+            cls.get_queue().put_nowait(delivery)
+        except QueueFull:
+            # Rather slow down this request than lose a message
+            cls.overflowed += 1
+            logger.warning(
+                "Delivery queue is full, delivering to user_id: {} "
+                "inline".format(user_id)
+            )
+            cls.deliver([delivery])
+
+    @classmethod
+    async def work(cls, queue):
+        config = inject.instance(Config)
+        batch_size = config.get('delivery_batch_size', 100)
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < batch_size and queue.qsize() > 0:
+                batch.append(queue.get_nowait())
+            db = inject.instance('db')
+            try:
+                # Reads push subscriptions, don't leave it idle in transaction
+                with transaction(db):
+                    cls.deliver(batch)
+            except Exception as e:
+                logger.exception("Delivery failed: {}".format(e))
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    @classmethod
+    def deliver(cls, batch):
+        cls.lag = time.monotonic() - batch[0].enqueued_at
+        cls.max_lag = max(cls.max_lag, cls.lag)
+        # Group by recipient, keeping order of each user's deliveries
+        by_user = OrderedDict()
+        for delivery in batch:
+            by_user.setdefault(delivery.user_id, []).append(delivery)
+        config = inject.instance(Config)
+        ack_timeout = config.get('push_ack_timeout')
+        if ack_timeout is None and inject.instance('pubsub').cross_process:
+            # Other processes can't say they delivered, rely on client acks
+            ack_timeout = cls.cross_process_ack_timeout
+        sends = []
+        for deliveries in by_user.values():
+            for delivery in deliveries:
+                data = delivery.data
+                delivery_id = None
+                ack = None
+                if delivery.push and ack_timeout is not None:
+                    delivery_id = str(uuid.uuid4())
+                    data = dict(data or dict(), delivery_id=delivery_id)
+                    ack = MessageWebSocketHandler.expect_ack(delivery_id)
+                sends.append((delivery, data, delivery_id, ack))
+        published = cls.publish(sends)
+        for delivery, data, delivery_id, ack in sends:
+            if ack is not None:
+                cls.deliver_with_ack(
+                    delivery, data, delivery_id, ack,
+                    delivery in published, ack_timeout
+                )
+            else:
+                delivered = delivery.send(data)
+                # User already got it in the app, push would be noise
+                if delivery.push and not delivered:
+                    cls.push(delivery.user_id, delivery.get_data())
+                elif delivery.push:
+                    cls.push_skipped += 1
+            cls.delivered += 1
+
+    @classmethod
+    def publish(cls, sends):
+        """
+        Publishes every frame once for all of its recipients, returns
+        deliveries that were published.
+        """
+        if not inject.instance('pubsub').cross_process:
+            return set()
+        groups = OrderedDict()
+        for delivery, data, _, _ in sends:
+            key = id(delivery)
+            if delivery.frame is not None:
+                key = (id(delivery.frame), delivery.coalesce_key)
+            if key not in groups:
+                groups[key] = (delivery, dict(), [])
+            _, recipients, deliveries = groups[key]
+            recipients[delivery.user_id] = data
+            deliveries.append(delivery)
+        published = set()
+        for delivery, recipients, deliveries in groups.values():
+            frame_data = None
+            if delivery.frame is not None:
+                frame_data = delivery.frame.data
+            user_ids = MessageWebSocketHandler.publish(
+                delivery.event, frame_data, recipients, delivery.coalesce_key
+            )
+            published.update(
+                grouped
+                for grouped in deliveries
+                if grouped.user_id in user_ids
+            )
+        return published
+
+    @classmethod
+    def push(cls, user_id, data):
+        cls.pushed += 1
+        PushCoalescer.add(user_id, data)
+
+    @classmethod
+    def deliver_with_ack(
+            cls, delivery, data, delivery_id, ack, published, ack_timeout
+    ):
+        user_id = delivery.user_id
+        delivered = delivery.send(data, delivery_id)
+        if ack.done():
+            # Device that doesn't ack got it
+            cls.push_skipped += 1
+            return
+        # Devices connected to other processes may still get it, their
+        # process confirms delivery like an ack
+        if not delivered and not published:
+            MessageWebSocketHandler.pending_acks.pop(delivery_id, None)
+            cls.push(user_id, delivery.get_data())
+            return
+        IOLoop.current().spawn_callback(
+            cls.push_unless_acked, user_id, delivery.get_data(),
+            delivery_id, ack, ack_timeout
+        )
+
+    @classmethod
+    async def push_unless_acked(
+            cls, user_id, data, delivery_id, ack, ack_timeout
+    ):
+        try:
+            await gen.with_timeout(timedelta(seconds=ack_timeout), ack)
+            cls.push_skipped += 1
+        except gen.TimeoutError as _:
+            # Socket was open but app did not show the message
+            MessageWebSocketHandler.pending_acks.pop(delivery_id, None)
+            db = inject.instance('db')
+            with transaction(db):
+                cls.push(user_id, data)
+
+    @classmethod
+    def metrics(cls):
+        depth = 0
+        if cls.queue is not None:
+            depth = cls.queue.qsize()
+        return {
+            "depth": depth,
+            "enqueued": cls.enqueued,
+            "delivered": cls.delivered,
+            "overflowed": cls.overflowed,
+            "pushed": cls.pushed,
+            "push_skipped": cls.push_skipped,
+            "lag": cls.lag,
+            "max_lag": cls.max_lag
+        }
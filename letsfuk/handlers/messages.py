@@ -8,7 +8,8 @@ from letsfuk.models.chat import (
     Chat, InvalidPayload,
     InvalidLimitOffset,
     ReceiverNotFound,
-    InvalidCount
+    InvalidCount,
+    InvalidCursor
 )
 from letsfuk.models.station import StationNotFound
 from letsfuk.models.user import UserNotFound
@@ -46,9 +47,32 @@ class MessagesHandler(BaseHandler):
         }, 200
 
 
+class BatchMessagesHandler(BaseHandler):
+    @endpoint_wrapper()
+    @map_exception(out_of=InvalidPayload, make=BadRequest)
+    @check_session()
+    @resolve_user()
+    @resolve_body()
+    def post(self):
+        Chat.verify_add_messages_payload(self.request.body)
+        results = Chat.add_batch(self.request.body, self.request.user)
+        return {"results": results}, 200
+
+
+class SyncMessagesHandler(BaseHandler):
+    @endpoint_wrapper()
+    @map_exception(out_of=InvalidCursor, make=BadRequest)
+    @check_session()
+    @resolve_user()
+    def get(self):
+        Chat.verify_sync_params(self.request.params)
+        sync = Chat.sync(self.request.user, self.request.params)
+        return sync.to_dict(), 200
+
+
 class ChatMessagesHandler(BaseHandler):
     @endpoint_wrapper()
-    @map_exception(out_of=InvalidLimitOffset, make=BadRequest)
+    @map_exception(out_of=(InvalidLimitOffset, InvalidCursor), make=BadRequest)
     @map_exception(out_of=ReceiverNotFound, make=NotFound)
     @check_session()
     @resolve_user()
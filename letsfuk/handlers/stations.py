@@ -31,7 +31,7 @@ class StationHandler(BaseHandler):
         members = Station.get_members(station)
         return {
            "station": station.to_dict(),
-           "members": [member.to_dict() for member in members]
+           "members": members
         }, 200
 
 
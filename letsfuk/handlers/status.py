@@ -1,7 +1,9 @@
 import logging
 
 from letsfuk.decorators import endpoint_wrapper
+from letsfuk.delivery import DeliveryQueue
 from letsfuk.handlers import BaseHandler
+from letsfuk.handlers.websocket import MessageWebSocketHandler
 
 logger = logging.getLogger(__name__)
 
@@ -11,3 +13,12 @@ class StatusHandler(BaseHandler):
     def get(self):
         logger.info("I'm alive, Letsfuk!")
         return "I'm alive, Letsfuk!", 200
+
+
+class MetricsHandler(BaseHandler):
+    @endpoint_wrapper()
+    def get(self):
+        return {
+            "delivery": DeliveryQueue.metrics(),
+            "websockets": MessageWebSocketHandler.metrics()
+        }, 200
@@ -1,21 +1,127 @@
 import json
 import logging
+import time
+import uuid
+from collections import OrderedDict
+from itertools import count
 
-from tornado.websocket import WebSocketHandler
+import inject
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
+
+from letsfuk.config import Config
 
 logger = logging.getLogger(__name__)
 
 
+class BroadcastFrame(object):
+    """
+    Message encoded once and shared by all recipients, fields that differ
+    per recipient are spliced into the encoded frame.
+    """
+    def __init__(self, event, data):
+        self.event = event
+        self.data = data
+        encoded = json.dumps({"event": event, "data": data})
+        # Drop closing braces of data and of the frame
+        self.head = encoded[:-2]
+        self.separator = ', ' if len(data) > 0 else ''
+
+    def render(self, fields=None):
+        if not fields:
+            return self.head + '}}'
+        encoded_fields = json.dumps(fields)[1:-1]
+        return self.head + self.separator + encoded_fields + '}}'
+
+    def to_dict(self, fields=None):
+        data = dict(self.data)
+        data.update(fields or dict())
+        return data
+
+
+class ConnectionRegistry(object):
+    """
+    Open sockets of every user, one per device, with a reverse index so
+    a closing socket finds its user without scanning everyone.
+    """
+    def __init__(self):
+        self.sockets = dict()
+        self.users = dict()
+
+    def add(self, user_id, web_socket):
+        previous_user_id = self.users.get(web_socket)
+        if previous_user_id == user_id:
+            return
+        if previous_user_id is not None:
+            self.remove(web_socket)
+        self.users[web_socket] = user_id
+        self.sockets.setdefault(user_id, set()).add(web_socket)
+
+    def remove(self, web_socket):
+        user_id = self.users.pop(web_socket, None)
+        if user_id is None:
+            return None
+        sockets = self.sockets.get(user_id)
+        sockets.discard(web_socket)
+        if len(sockets) == 0:
+            del self.sockets[user_id]
+        return user_id
+
+    def get(self, user_id):
+        # Copy, writing to a socket may close it and change the set
+        return list(self.sockets.get(user_id, ()))
+
+    def __contains__(self, user_id):
+        return user_id in self.sockets
+
+    def __len__(self):
+        return len(self.users)
+
+
 class MessageWebSocketHandler(WebSocketHandler):
-    live_web_sockets = dict()
+    live_web_sockets = ConnectionRegistry()
+    pending_acks = dict()
+    messages_channel = 'websocket_messages'
+    acks_channel = 'websocket_acks'
+    # Tells this process' own messages apart when they come back
+    process_id = str(uuid.uuid4())
+    frame_ids = count()
+    slow_consumers_closed = 0
+    connect_timeouts = 0
+    idle_evicted = 0
 
     def check_origin(self, origin):
         return True
 
     def open(self):
         self.set_nodelay(True)
+        # Frames waiting to be written, coalescible ones under their key
+        self.outbox = OrderedDict()
+        self.buffered = 0
+        self.writing = False
+        self.over_high_water_since = None
+        self.last_seen = time.monotonic()
+        # Only clients that say so ack deliveries, others are never waited
+        self.acks = False
+        # Sockets that never say who they are would never be delivered to
+        config = inject.instance(Config)
+        self.connect_deadline = IOLoop.current().call_later(
+            config.get('websocket_connect_timeout', 10),
+            self.on_connect_timeout
+        )
+
+    def on_connect_timeout(self):
+        self.connect_deadline = None
+        if self not in self.live_web_sockets.users:
+            self.__class__.connect_timeouts += 1
+            self.close(1008, "Connect event not sent")
+
+    def on_pong(self, data):
+        self.last_seen = time.monotonic()
 
     def on_message(self, data):
+        self.last_seen = time.monotonic()
         message = json.loads(data)
         if isinstance(message, dict):
             message_type = message.get('event')
@@ -23,31 +129,289 @@ class MessageWebSocketHandler(WebSocketHandler):
                 if message_type == 'connect':
                     data = message.get('data')
                     user_id = data.get('id')
-                    self.live_web_sockets[user_id] = self
+                    self.acks = bool(data.get('acks'))
+                    self.live_web_sockets.add(user_id, self)
+                    if self.connect_deadline is not None:
+                        IOLoop.current().remove_timeout(self.connect_deadline)
+                        self.connect_deadline = None
                     logger.info(
                         "Web socket opened for user_id: {}".format(user_id)
                     )
+                elif message_type == 'ack':
+                    data = message.get('data')
+                    delivery_id = data.get('delivery_id')
+                    self.confirm_delivery(delivery_id)
 
     def on_close(self):
-        for user_id in self.live_web_sockets:
-            ws = self.live_web_sockets[user_id]
-            if ws == self:
-                _ = self.live_web_sockets.pop(user_id)
-                logger.info(
-                    "Web socket closed for user_id: {}".format(user_id)
+        if self.connect_deadline is not None:
+            IOLoop.current().remove_timeout(self.connect_deadline)
+            self.connect_deadline = None
+        user_id = self.live_web_sockets.remove(self)
+        if user_id is not None:
+            logger.info(
+                "Web socket closed for user_id: {}".format(user_id)
+            )
+
+    @classmethod
+    def subscribe(cls, pubsub):
+        pubsub.subscribe(cls.messages_channel, cls.on_published_message)
+        pubsub.subscribe(cls.acks_channel, cls.resolve_ack)
+
+    @classmethod
+    def make_payloads(cls, event, data, recipients, coalesce_key, limit):
+        """
+        Encodes a frame for all recipients at once, split into as many
+        payloads as it takes to keep each one under the limit.
+        """
+        encoded = json.dumps({
+            "process_id": cls.process_id,
+            # Backend may drop identical payloads, keep each one unique
+            "id": next(cls.frame_ids),
+            "event": event,
+            "data": data,
+            "coalesce_key": coalesce_key,
+            "recipients": recipients
+        })
+        if limit is None or len(encoded.encode()) <= limit:
+            return [(encoded, list(recipients))]
+        if len(recipients) == 1:
+            logger.warning(
+                "Frame for user_id: {} is too big to publish".format(
+                    list(recipients)[0]
                 )
-                break
+            )
+            return []
+        user_ids = list(recipients)
+        middle = len(user_ids) // 2
+        payloads = []
+        for part in [user_ids[:middle], user_ids[middle:]]:
+            payloads.extend(cls.make_payloads(
+                event, data,
+                {user_id: recipients[user_id] for user_id in part},
+                coalesce_key, limit
+            ))
+        return payloads
+
+    @classmethod
+    def publish(cls, event, data, recipients, coalesce_key=None):
+        """
+        Sends a frame to recipients' devices connected to other processes.
+        Shared data is sent once, recipients map user_id to the fields
+        spliced into it, without shared data their fields are the data.
+        Returns user ids the frame was published for.
+        """
+        pubsub = inject.instance('pubsub')
+        if not pubsub.cross_process or len(recipients) == 0:
+            return set()
+        published = set()
+        try:
+            for payload, user_ids in cls.make_payloads(
+                    event, data, recipients, coalesce_key, pubsub.max_payload
+            ):
+                pubsub.publish(cls.messages_channel, payload)
+                published.update(user_ids)
+        except Exception as e:
+            # Devices connected to this process still get it
+            logger.exception("Publishing frame failed: {}".format(e))
+        return published
+
+    @classmethod
+    def on_published_message(cls, payload):
+        message = json.loads(payload)
+        # Own messages were already written to local sockets
+        if message.get('process_id') == cls.process_id:
+            return
+        event = message.get('event')
+        data = message.get('data')
+        coalesce_key = message.get('coalesce_key')
+        frame = None
+        if data is not None:
+            frame = BroadcastFrame(event, data)
+        for user_id, fields in message.get('recipients').items():
+            if user_id not in cls.live_web_sockets:
+                continue
+            if frame is not None:
+                rendered = frame.render(fields)
+            else:
+                rendered = json.dumps({"event": event, "data": fields})
+            delivery_id = None
+            if isinstance(fields, dict):
+                delivery_id = fields.get('delivery_id')
+            cls.send_local(user_id, rendered, coalesce_key, delivery_id)
+
+    @classmethod
+    def expect_ack(cls, delivery_id):
+        future = Future()
+        cls.pending_acks[delivery_id] = future
+        return future
+
+    @classmethod
+    def resolve_ack(cls, delivery_id):
+        future = cls.pending_acks.pop(delivery_id, None)
+        if future is None:
+            return False
+        if not future.done():
+            future.set_result(True)
+        return True
+
+    @classmethod
+    def confirm_delivery(cls, delivery_id):
+        if not cls.resolve_ack(delivery_id):
+            # Delivery is waited for in another process
+            pubsub = inject.instance('pubsub')
+            if pubsub.cross_process:
+                pubsub.publish(cls.acks_channel, delivery_id)
+
+    @classmethod
+    def send_message(
+            cls, user_id, event='message', data=None, coalesce_key=None
+    ):
+        """
+        Sends to user's devices in every process, returns whether any
+        device connected to this process got it.
+        """
+        _ = cls.publish(event, None, {user_id: data}, coalesce_key)
+        return cls.send_local(user_id, json.dumps({
+            "event": event,
+            "data": data
+        }), coalesce_key)
 
     @classmethod
-    def send_message(cls, user_id, event='message', data=None):
-        web_socket = cls.live_web_sockets.get(user_id)
-        if web_socket is not None:
-            web_socket.write_message({
-                "event": event,
-                "data": data
-            })
+    def send_local(cls, user_id, frame, coalesce_key=None, delivery_id=None):
+        """
+        Pending frame with the same coalesce key is replaced instead of
+        queueing another one. Delivery is confirmed as soon as a device
+        that doesn't ack gets it.
+        """
+        sent = False
+        confirmed = False
+        for web_socket in cls.live_web_sockets.get(user_id):
+            if not web_socket.queue_frame(frame, coalesce_key):
+                cls.live_web_sockets.remove(web_socket)
+                continue
+            sent = True
+            if not web_socket.acks:
+                confirmed = True
+        if delivery_id is not None and confirmed:
+            cls.confirm_delivery(delivery_id)
+        if sent:
             logger.info(
-                "Sent message to user_id: {}, event: {}, data: {}".format(
-                    user_id, event, data
+                "Sent message to user_id: {}, frame: {}".format(
+                    user_id, frame
                 )
             )
+        return sent
+
+    def queue_frame(self, frame, coalesce_key=None):
+        if self.ws_connection is None or self.ws_connection.is_closing():
+            return False
+        if coalesce_key is not None and coalesce_key in self.outbox:
+            # Replaced frame goes behind everything queued before it
+            self.buffered -= len(self.outbox.pop(coalesce_key))
+        elif coalesce_key is None:
+            coalesce_key = next(self.frame_ids)
+        self.outbox[coalesce_key] = frame
+        self.buffered += len(frame)
+        if self.is_slow_consumer():
+            self.close_slow_consumer()
+            return False
+        if not self.writing:
+            self.writing = True
+            IOLoop.current().spawn_callback(self.write_outbox)
+        return True
+
+    def is_slow_consumer(self):
+        config = inject.instance(Config)
+        high_water = config.get('websocket_high_water', 1024 * 1024)
+        slow_timeout = config.get('websocket_slow_timeout', 30)
+        # Grace period is for short stalls, not for holding any amount
+        hard_limit = config.get('websocket_hard_limit', 4 * high_water)
+        if self.buffered > hard_limit:
+            return True
+        if self.buffered <= high_water:
+            self.over_high_water_since = None
+            return False
+        now = time.monotonic()
+        if self.over_high_water_since is None:
+            self.over_high_water_since = now
+        return now - self.over_high_water_since > slow_timeout
+
+    def close_slow_consumer(self):
+        logger.warning(
+            "Closing slow web socket for user_id: {}, "
+            "buffered bytes: {}".format(
+                self.live_web_sockets.users.get(self), self.buffered
+            )
+        )
+        self.__class__.slow_consumers_closed += 1
+        self.live_web_sockets.remove(self)
+        # Frames would never be written, let them go right away
+        self.outbox.clear()
+        self.buffered = 0
+        self.close(1008, "Too slow")
+
+    async def write_outbox(self):
+        try:
+            while len(self.outbox) > 0:
+                _, frame = self.outbox.popitem(last=False)
+                # Waits until frame left for the client, so a slow link
+                # piles frames up in outbox where they are counted
+                await self.write_message(frame)
+                # Outbox may have been dropped meanwhile by a close
+                self.buffered = max(self.buffered - len(frame), 0)
+            # Client caught up
+            self.over_high_water_since = None
+        except WebSocketClosedError as _:
+            self.outbox.clear()
+            self.buffered = 0
+        finally:
+            self.writing = False
+
+    @classmethod
+    def sweep(cls):
+        """
+        Evicts sockets nothing was heard from for websocket_idle_timeout
+        seconds, pongs included, these are half-open connections.
+        """
+        config = inject.instance(Config)
+        idle_timeout = config.get('websocket_idle_timeout', 120)
+        now = time.monotonic()
+        idle = [
+            web_socket
+            for web_socket in cls.live_web_sockets.users
+            if now - web_socket.last_seen > idle_timeout
+        ]
+        for web_socket in idle:
+            cls.live_web_sockets.remove(web_socket)
+            web_socket.close(1001, "Idle")
+        cls.idle_evicted += len(idle)
+        # Stalled sockets that get no new frames are caught here
+        slow = [
+            web_socket
+            for web_socket in cls.live_web_sockets.users
+            if web_socket.is_slow_consumer()
+        ]
+        for web_socket in slow:
+            web_socket.close_slow_consumer()
+        logger.info(
+            "Web socket sweep, users: {}, sockets: {}, evicted: {}".format(
+                len(cls.live_web_sockets.sockets),
+                len(cls.live_web_sockets), len(idle)
+            )
+        )
+
+    @classmethod
+    def metrics(cls):
+        buffered = [
+            web_socket.buffered
+            for web_socket in cls.live_web_sockets.users
+        ]
+        return {
+            "connections": len(cls.live_web_sockets),
+            "users": len(cls.live_web_sockets.sockets),
+            "buffered_bytes": sum(buffered),
+            "max_buffered_bytes": max(buffered, default=0),
+            "slow_consumers_closed": cls.slow_consumers_closed,
+            "connect_timeouts": cls.connect_timeouts,
+            "idle_evicted": cls.idle_evicted
+        }
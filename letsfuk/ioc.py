@@ -3,8 +3,9 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 import testing.postgresql
 
-from letsfuk.cache import Memcache
+from letsfuk.cache import Memcache, StationMembers
 from letsfuk.config import Config
+from letsfuk.pubsub import make_pubsub, MemoryPubSub
 
 
 def configuration(binder):
@@ -18,10 +19,12 @@ def configuration(binder):
         timeout=5
     )
     Memcache.memcache = cache
+    StationMembers.ttl = config.get('station_members_ttl', 60)
     binder.bind('cache', cache)
     binder.bind_to_provider('db', session_class)
     binder.bind(Config, config)
     binder.bind('db_engine', engine)
+    binder.bind('pubsub', make_pubsub(config, engine))
 
 
 def testing_configuration(binder):
@@ -36,3 +39,4 @@ def testing_configuration(binder):
     binder.bind_to_provider('db', session_class)
     binder.bind(Config, config)
     binder.bind('db_engine', engine)
+    binder.bind('pubsub', MemoryPubSub())
@@ -1,15 +1,21 @@
+import base64
+import binascii
+import json
 import logging
 import uuid
 import inject
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from letsfuk import Config
+from letsfuk.cache import StationMembers, UserProfiles
+from letsfuk.db import after_commit
 from letsfuk.db.models import (
     User, Subscriber, Station, PrivateChat,
-    StationChat, Unread
+    StationChat, Unread, Conversation, ReadPointer, get_sync_boundary
 )
-from letsfuk.models.push_notifications import PushNotifications
-from letsfuk.models.station import StationNotFound
+from letsfuk.delivery import DeliveryQueue
+from letsfuk.handlers.websocket import BroadcastFrame
+from letsfuk.models.station import StationNotFound, Station as StationModel
 from letsfuk.models.user import UserNotFound
 
 logger = logging.getLogger(__name__)
@@ -31,7 +37,13 @@ class InvalidCount(Exception):
     pass
 
 
+class InvalidCursor(Exception):
+    pass
+
+
 class Chat(object):
+    cursor_time_format = '%Y-%m-%dT%H:%M:%S.%f'
+
     @classmethod
     def verify_user(cls, user_id):
         db = inject.instance('db')
@@ -119,6 +131,111 @@ class Chat(object):
         cls.verify_param(offset)
         cls.verify_param(limit)
 
+    @classmethod
+    def encode_cursor_value(cls, value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+    @classmethod
+    def decode_cursor_value(cls, cursor):
+        try:
+            value = base64.urlsafe_b64decode(cursor.encode()).decode()
+            return json.loads(value)
+        except (binascii.Error, UnicodeError, ValueError) as _:
+            raise InvalidCursor("Invalid cursor")
+
+    @classmethod
+    def format_position(cls, position):
+        if position is None:
+            return None
+        sent_at, message_id = position
+        return [sent_at.strftime(cls.cursor_time_format), message_id]
+
+    @classmethod
+    def parse_position(cls, value):
+        try:
+            formatted_sent_at, message_id = value
+            sent_at = datetime.strptime(
+                formatted_sent_at, cls.cursor_time_format
+            )
+        except (TypeError, ValueError) as _:
+            raise InvalidCursor("Invalid cursor")
+        if not isinstance(message_id, int):
+            raise InvalidCursor("Invalid cursor")
+        return sent_at, message_id
+
+    @classmethod
+    def encode_cursor(cls, message):
+        position = (message.sent_at, message.id)
+        return cls.encode_cursor_value(cls.format_position(position))
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        return cls.parse_position(cls.decode_cursor_value(cursor))
+
+    @classmethod
+    def encode_sync_cursor(
+            cls, station_id, private_position, station_position,
+            unread_position
+    ):
+        return cls.encode_cursor_value({
+            "station_id": station_id,
+            "private": list(private_position),
+            "station": list(station_position),
+            "unread": unread_position
+        })
+
+    @classmethod
+    def parse_sync_position(cls, value):
+        try:
+            sync_xid, message_id = value
+        except (TypeError, ValueError) as _:
+            raise InvalidCursor("Invalid cursor")
+        if not isinstance(sync_xid, int) or not isinstance(message_id, int):
+            raise InvalidCursor("Invalid cursor")
+        return sync_xid, message_id
+
+    @classmethod
+    def decode_sync_cursor(cls, cursor):
+        value = cls.decode_cursor_value(cursor)
+        if not isinstance(value, dict):
+            raise InvalidCursor("Invalid cursor")
+        private_position = cls.parse_sync_position(value.get("private"))
+        station_position = cls.parse_sync_position(value.get("station"))
+        unread_position = value.get("unread")
+        if not isinstance(unread_position, int):
+            raise InvalidCursor("Invalid cursor")
+        return (
+            value.get("station_id"), private_position, station_position,
+            unread_position
+        )
+
+    @classmethod
+    def verify_sync_params(cls, params):
+        since = params.get("since")
+        if since is not None:
+            cls.decode_sync_cursor(since)
+
+    @classmethod
+    def verify_cursors(cls, params):
+        before = params.get("before")
+        after = params.get("after")
+        if before is not None and after is not None:
+            raise InvalidCursor("Provide either before or after cursor!")
+        if before is not None:
+            cls.decode_cursor(before)
+        if after is not None:
+            cls.decode_cursor(after)
+
+    @classmethod
+    def get_cursors(cls, params):
+        before = params.get("before")
+        after = params.get("after")
+        if before is not None:
+            before = cls.decode_cursor(before)
+        if after is not None:
+            after = cls.decode_cursor(after)
+        return before, after
+
     @classmethod
     def get_params(cls, params, default_limit):
         offset_formatted = params.get("offset", 0)
@@ -130,6 +247,7 @@ class Chat(object):
     @classmethod
     def verify_get_messages_payload(cls, receiver_id, params):
         cls.verify_params(params)
+        cls.verify_cursors(params)
         cls.verify_get_messages_receiver(receiver_id)
 
     @classmethod
@@ -142,58 +260,113 @@ class Chat(object):
                 "There is not receiver_id: {}".format(receiver_id)
             )
 
+    @classmethod
+    def add_private_messages(cls, user_id, sender, contents):
+        db = inject.instance('db')
+        messages = []
+        for message_id, text, image_key, sent_at in contents:
+            message = PrivateChat.add(
+                db, message_id, user_id, sender.user_id,
+                text, image_key, sent_at
+            )
+            _ = Conversation.add_message(db, message)
+            messages.append(message)
+        # One counter bump for all of them, each message gets the value
+        # the counter had right after it
+        unread = Unread.increment(
+            db, user_id, sender_id=sender.user_id, amount=len(messages)
+        )
+        first_unread = unread - len(messages) + 1
+        senders = MessageResponse.load_senders(messages)
+        message_responses = []
+        for i, message in enumerate(messages):
+            message_response = MessageResponse(message, senders)
+            data = {
+                "is_station": False,
+                "unread": first_unread + i
+            }
+            data.update(message_response.to_dict())
+            # Nothing is sent for messages that end up rolled back
+            after_commit(
+                db, DeliveryQueue.enqueue, user_id, event='message',
+                data=data, push=True
+            )
+            message_responses.append(message_response)
+        return message_responses
+
     @classmethod
     def add_private_message(
             cls, message_id, user_id, sender, text, image_key, sent_at
     ):
-        db = inject.instance('db')
-        message = PrivateChat.add(
-            db, message_id, user_id, sender.user_id, text, image_key, sent_at
+        message_responses = cls.add_private_messages(
+            user_id, sender, [(message_id, text, image_key, sent_at)]
         )
-        unread = Unread.add(db, user_id, sender_id=sender.user_id)
-        message_response = MessageResponse(message)
-        data = {
-            "is_station": False,
-            "unread": unread.count
-        }
-        data.update(message_response.to_dict())
-        from letsfuk import MessageWebSocketHandler
-        MessageWebSocketHandler.send_message(
-            user_id, event='message',
-            data=data
+        return message_responses[0]
+
+    @classmethod
+    def add_station_messages(cls, station, sender, contents):
+        db = inject.instance('db')
+        messages = [
+            StationChat.add(
+                db, message_id, station.station_id, sender.user_id,
+                text, image_key, sent_at
+            )
+            for message_id, text, image_key, sent_at in contents
+        ]
+        Station.increment_message_count(
+            db, station.station_id, amount=len(messages)
         )
-        PushNotifications.send_to_user(user_id, data)
-        return MessageResponse(message)
+        # Not the cached list, counters written for a stale one would
+        # stay wrong for good
+        member_ids = [
+            member_id
+            for member_id in Subscriber.get_member_ids(db, station.station_id)
+            if member_id != sender.user_id
+        ]
+        # Sender is the same for every recipient, render messages only once
+        senders = MessageResponse.load_senders(messages)
+        message_responses = [
+            MessageResponse(message, senders) for message in messages
+        ]
+        # Bump every member's counter with one statement, in pointer mode
+        # nothing is written and counts come from members' read pointers
+        cap = None
+        if cls.is_pointer_mode(station.station_id):
+            config = inject.instance(Config)
+            cap = config.get('unread_display_cap', 99)
+            unreads = ReadPointer.count_unread_for_users(
+                db, station.station_id, member_ids, cap
+            )
+        else:
+            unreads = Unread.add_for_station(
+                db, station.station_id, member_ids, amount=len(messages)
+            )
+        for i, message_response in enumerate(message_responses):
+            data = {
+                "is_station": True
+            }
+            data.update(message_response.to_dict())
+            # Encoded once, only unread is spliced in per member
+            frame = BroadcastFrame('message', data)
+            for member_id in member_ids:
+                unread = unreads.get(member_id)
+                # Capped count says nothing about earlier messages
+                if unread is not None and unread != cap:
+                    unread = max(unread - len(messages) + 1 + i, 0)
+                after_commit(
+                    db, DeliveryQueue.enqueue, member_id, event='message',
+                    data={"unread": unread}, push=True, frame=frame
+                )
+        return message_responses
 
     @classmethod
     def add_station_message(
             cls, message_id, station, sender, text, image_key, sent_at
     ):
-        db = inject.instance('db')
-        message = StationChat.add(
-            db, message_id, station.station_id, sender.user_id,
-            text, image_key, sent_at
-        )
-        station_users = Subscriber.get_users_for_station(
-            db, station.station_id
+        message_responses = cls.add_station_messages(
+            station, sender, [(message_id, text, image_key, sent_at)]
         )
-        from letsfuk import MessageWebSocketHandler
-        for station_user in station_users:
-            if station_user.user_id != sender.user_id:
-                unread = Unread.add(
-                    db, station_user.user_id, station_id=station.station_id
-                )
-                message_response = MessageResponse(message)
-                data = {
-                    "is_station": True,
-                    "unread": unread.count
-                }
-                data.update(message_response.to_dict())
-                MessageWebSocketHandler.send_message(
-                    station_user.user_id, event='message',
-                    data=data
-                )
-        return MessageResponse(message)
+        return message_responses[0]
 
     @classmethod
     def add(cls, payload, sender):
@@ -212,24 +385,98 @@ class Chat(object):
             message_id, station, sender, text, image_key, sent_at
         )
 
+    @classmethod
+    def verify_add_messages_payload(cls, payload):
+        config = inject.instance(Config)
+        batch_limit = config.get('message_batch_limit', 50)
+        messages = payload.get("messages")
+        if not isinstance(messages, list):
+            raise InvalidPayload("Messages must be a list!")
+        if len(messages) == 0:
+            raise InvalidPayload("Messages must not be empty!")
+        if len(messages) > batch_limit:
+            raise InvalidPayload(
+                "Too many messages, {} is the limit!".format(batch_limit)
+            )
+
+    @classmethod
+    def add_batch(cls, payload, sender):
+        """
+        Stores all valid messages in one go, invalid ones get an error
+        in their place so clients know which ones to retry.
+        """
+        db = inject.instance('db')
+        results = []
+        # Receiver -> [(index, message content)]
+        private_contents = dict()
+        station_contents = []
+        now = datetime.utcnow()
+        for i, item in enumerate(payload.get("messages")):
+            try:
+                if not isinstance(item, dict):
+                    raise InvalidPayload("Message must be an object!")
+                cls.verify_add_message_payload(item)
+            except InvalidPayload as e:
+                results.append({"status_code": 400, "text": str(e)})
+                continue
+            except UserNotFound as e:
+                results.append({"status_code": 404, "text": str(e)})
+                continue
+            results.append(None)
+            # Spread sent_at so messages keep their order in the chat
+            content = (
+                str(uuid.uuid4()), item.get("text"), item.get("image_key"),
+                now + timedelta(microseconds=i)
+            )
+            user_id = item.get("user_id")
+            if user_id is not None:
+                private_contents.setdefault(user_id, []).append((i, content))
+            else:
+                station_contents.append((i, content))
+        added = []
+        # Counters are locked in receiver order, keep it the same for
+        # every request so concurrent batches can't deadlock
+        for user_id, contents in sorted(private_contents.items()):
+            message_responses = cls.add_private_messages(
+                user_id, sender, [content for _, content in contents]
+            )
+            added.extend(zip(
+                [i for i, _ in contents], message_responses
+            ))
+        if len(station_contents) > 0:
+            station = Subscriber.get_station_for_user(db, sender.user_id)
+            message_responses = cls.add_station_messages(
+                station, sender, [content for _, content in station_contents]
+            )
+            added.extend(zip(
+                [i for i, _ in station_contents], message_responses
+            ))
+        for i, message_response in added:
+            results[i] = {
+                "status_code": 200,
+                "message": message_response.to_dict()
+            }
+        return results
+
     @classmethod
     def get_total(cls, receiver_id, sender_id):
         db = inject.instance('db')
         station = Station.query_by_station_id(db, receiver_id)
         if station is not None:
-            total = StationChat.get_total(
-                db, station.station_id
-            )
+            return station.message_count
+        # Chat with yourself has no conversation row
+        if receiver_id == sender_id:
+            total = PrivateChat.get_total(db, receiver_id, sender_id)
             return total
-        total = PrivateChat.get_total(
-            db, receiver_id, sender_id
-        )
-        return total
+        conversation = Conversation.get(db, sender_id, receiver_id)
+        if conversation is None:
+            return 0
+        return conversation.count
 
     @classmethod
     def get_total_chats(cls, user):
         db = inject.instance('db')
-        total = PrivateChat.get_total_chats(db, user.user_id)
+        total = Conversation.get_total(db, user.user_id)
         # Plus one more for station chat
         return total + 1
 
@@ -239,11 +486,12 @@ class Chat(object):
         config = inject.instance(Config)
         default_chat_limit = config.get('default_chat_limit', 20)
         offset, limit = cls.get_params(params, default_chat_limit)
+        before, after = cls.get_cursors(params)
         db = inject.instance('db')
         station = Station.query_by_station_id(db, receiver_id)
         if station is not None:
             messages = StationChat.get(
-                db, station.station_id, offset, limit
+                db, station.station_id, offset, limit, before, after
             )
             unread_count = cls.get_unread_in_station_for_user(
                 sender_id, station.station_id
@@ -253,7 +501,7 @@ class Chat(object):
             )
             return station_chat
         messages = PrivateChat.get(
-            db, receiver_id, sender_id, offset, limit
+            db, receiver_id, sender_id, offset, limit, before, after
         )
         unread_count = cls.get_unread_in_private_for_user(
             sender_id, receiver_id
@@ -268,27 +516,157 @@ class Chat(object):
         offset, limit = cls.get_params(params, default_limit)
         db = inject.instance('db')
         station = Subscriber.get_station_for_user(db, sender.user_id)
-        station_chat = cls.get(
-            station.station_id, sender.user_id, {}
-        )
-        chat_user_ids = PrivateChat.get_user_ids_for_user_id(
+        chat_user_ids = Conversation.get_partner_ids(
             db, sender.user_id, offset, limit
         )
+        default_chat_limit = config.get('default_chat_limit', 20)
+        station_messages = StationChat.get(
+            db, station.station_id, 0, default_chat_limit
+        )
+        chats_messages = PrivateChat.get_latest_for_partners(
+            db, sender.user_id, chat_user_ids, default_chat_limit
+        )
+        # Load senders of all messages in inbox with one query
+        senders = MessageResponse.load_senders(
+            station_messages + [
+                message
+                for messages in chats_messages.values()
+                for message in messages
+            ]
+        )
+        station_unread, private_unreads = cls.get_unreads_for_user(
+            sender.user_id, station.station_id, chat_user_ids
+        )
+        # Partners are mostly senders already, load the rest in one go
+        profiles = dict(senders)
+        missing_ids = [
+            user_id for user_id in chat_user_ids if user_id not in profiles
+        ]
+        if len(missing_ids) > 0:
+            profiles.update(UserProfiles.get_many(
+                missing_ids, MessageResponse.query_senders
+            ))
+        station_chat = ChatResponse(
+            station.station_id, station_messages, station_unread, senders,
+            ChatResponse.station_receiver(station)
+        )
         private_chats = []
         for receiver_id in chat_user_ids:
-            default_chat_limit = config.get('default_chat_limit', 20)
-            messages = PrivateChat.get(
-                db, receiver_id, sender.user_id, 0, default_chat_limit
-            )
-            unread_count = cls.get_unread_in_private_for_user(
-                sender.user_id, receiver_id
+            messages = chats_messages[receiver_id]
+            unread_count = private_unreads.get(receiver_id, 0)
+            receiver = dict()
+            if receiver_id in profiles:
+                receiver = ChatResponse.user_receiver(
+                    receiver_id, profiles[receiver_id]
+                )
+            private_chat = ChatResponse(
+                receiver_id, messages, unread_count, senders, receiver
             )
-            private_chat = ChatResponse(receiver_id, messages, unread_count)
             private_chats.append(private_chat)
         return station_chat, private_chats
 
+    @classmethod
+    def get_position(cls, messages, default):
+        if len(messages) == 0:
+            return default
+        message = messages[-1]
+        return message.sync_xid, message.id
+
+    @classmethod
+    def sync(cls, user, params):
+        config = inject.instance(Config)
+        sync_limit = config.get('sync_limit', 500)
+        db = inject.instance('db')
+        station = Subscriber.get_station_for_user(db, user.user_id)
+        # Only rows of finished transactions are handed out, so one that
+        # commits late can't end up behind a cursor already sent
+        boundary = get_sync_boundary(db)
+        start_position = (boundary, 0)
+        since = params.get("since")
+        if since is None:
+            # No cursor yet, hand out one pointing at the newest messages
+            cursor = cls.encode_sync_cursor(
+                station.station_id, start_position, start_position, boundary
+            )
+            return SyncResponse(
+                station.station_id, [], [], 0, dict(), cursor, False
+            )
+        (
+            station_id, private_position, station_position, unread_position
+        ) = cls.decode_sync_cursor(since)
+        if station_id != station.station_id:
+            # Client has to load the new station, old position means
+            # nothing there
+            station_position = start_position
+        # One extra row tells if client has to sync again
+        private_messages = PrivateChat.get_since(
+            db, user.user_id, private_position, boundary, sync_limit + 1
+        )
+        station_messages = StationChat.get_since(
+            db, station.station_id, station_position, boundary,
+            sync_limit + 1
+        )
+        has_more = (
+            len(private_messages) > sync_limit or
+            len(station_messages) > sync_limit
+        )
+        private_messages = private_messages[:sync_limit]
+        station_messages = station_messages[:sync_limit]
+        # Every counter written since last sync, resets from other
+        # devices included
+        unreads = Unread.get_private_since(
+            db, user.user_id, unread_position, boundary
+        )
+        private_unreads = {
+            unread.sender_id: unread.count for unread in unreads
+        }
+        station_unread = cls.get_unread_in_station_for_user(
+            user.user_id, station.station_id
+        )
+        cursor = cls.encode_sync_cursor(
+            station.station_id,
+            cls.get_position(private_messages, private_position),
+            cls.get_position(station_messages, station_position),
+            boundary
+        )
+        return SyncResponse(
+            station.station_id, private_messages, station_messages,
+            station_unread, private_unreads, cursor, has_more
+        )
+
+    @classmethod
+    def get_unreads_for_user(cls, user_id, station_id, sender_ids):
+        db = inject.instance('db')
+        unreads = Unread.get_for_user(
+            db, user_id, station_id=station_id, sender_ids=sender_ids
+        )
+        station_count = 0
+        private_counts = dict()
+        for unread in unreads:
+            if unread.sender_id is None:
+                station_count = unread.count
+            else:
+                private_counts[unread.sender_id] = unread.count
+        if cls.is_pointer_mode(station_id):
+            station_count = cls.count_unread_in_station(user_id, station_id)
+        return station_count, private_counts
+
+    @classmethod
+    def is_pointer_mode(cls, station_id):
+        return StationModel.is_pointer_mode(station_id)
+
+    @classmethod
+    def count_unread_in_station(cls, user_id, station_id):
+        config = inject.instance(Config)
+        cap = config.get('unread_display_cap', 99)
+        db = inject.instance('db')
+        unread_count = ReadPointer.count_unread(db, user_id, station_id, cap)
+        return unread_count
+
     @classmethod
     def get_unread_in_station_for_user(cls, user_id, station_id):
+        if cls.is_pointer_mode(station_id):
+            return cls.count_unread_in_station(user_id, station_id)
         db = inject.instance('db')
         unread = Unread.get(db, user_id, station_id=station_id)
         unread_count = 0
@@ -315,18 +693,54 @@ class Chat(object):
             db, user.user_id, station_id=station_id,
             sender_id=sender_id, count=count
         )
+        if station_id is not None and sender_id is None:
+            # Pointer is moved in both modes so station can switch any time
+            ReadPointer.move_to_unread(db, user.user_id, station_id, count)
+            if cls.is_pointer_mode(station_id):
+                unread = Unread(
+                    receiver_id=user.user_id,
+                    station_id=station_id,
+                    count=cls.count_unread_in_station(
+                        user.user_id, station_id
+                    )
+                )
+        # Keeps badges on user's other devices in sync, only the latest
+        # count matters so a pending one is replaced
+        after_commit(
+            db, DeliveryQueue.enqueue, user.user_id, event='unread',
+            data=unread.to_dict(),
+            coalesce_key='unread:{}'.format(station_id or sender_id)
+        )
         return unread
 
 
 class MessageResponse(object):
-    def __init__(self, message):
+    def __init__(self, message, senders=None):
         self.message = message
 
+        # Senders are loaded in bulk by whoever renders a whole page,
+        # fall back to a single lookup for lone messages
+        if senders is None:
+            senders = self.load_senders([message])
+        self.sender = senders.get(message.sender_id, dict())
+
+    @classmethod
+    def load_senders(cls, messages):
+        sender_ids = {
+            message.sender_id
+            for message in messages
+            if message.sender_id is not None
+        }
+        if len(sender_ids) == 0:
+            return dict()
+        senders = UserProfiles.get_many(list(sender_ids), cls.query_senders)
+        return senders
+
+    @classmethod
+    def query_senders(cls, sender_ids):
         db = inject.instance('db')
-        self.sender = dict()
-        user = User.query_by_user_id(db, message.sender_id)
-        if user is not None:
-            self.sender = user.to_dict()
+        users = User.query_by_user_ids(db, sender_ids)
+        return {user.user_id: user.to_dict() for user in users}
 
     def to_dict(self):
         result = self.message.to_dict()
@@ -336,53 +750,117 @@ class MessageResponse(object):
 
 
 class ChatResponse(object):
-    def __init__(self, receiver_id, messages, unread=None):
+    def __init__(
+            self, receiver_id, messages, unread=None, senders=None,
+            receiver=None
+    ):
         self.unread = unread
 
+        # Inbox passes receivers it loaded for all chats at once
+        if receiver is None:
+            receiver = self.load_receiver(receiver_id)
+        self.receiver = receiver
+
+        # Message bodies come straight from the loaded rows, senders come
+        # from versioned profile cache
+        if senders is None:
+            senders = MessageResponse.load_senders(messages)
+        self.messages = [
+            MessageResponse(message, senders).to_dict()
+            for message in reversed(messages)
+        ]
+
+        # Messages are newest first, cursors point to both ends of the page
+        self.before = None
+        self.after = None
+        if len(messages) > 0:
+            self.before = Chat.encode_cursor(messages[-1])
+            self.after = Chat.encode_cursor(messages[0])
+
+    @classmethod
+    def load_receiver(cls, receiver_id):
         db = inject.instance('db')
-        self.receiver = dict()
+        receiver = dict()
         user = User.query_by_user_id(db, receiver_id)
         if user is not None:
-            self.receiver = user.to_dict()
-            self.receiver.update(id=user.user_id)
-            self.receiver.update(is_station=False)
+            receiver = cls.user_receiver(user.user_id, user.to_dict())
         station = Station.query_by_station_id(db, receiver_id)
         if station is not None:
-            members = Subscriber.get_users_for_station(
-                db, station.station_id
-            )
-            self.receiver.update(
-                id=station.station_id,
-                username="Station",
-                is_station=True,
-                members=[member.to_dict() for member in members]
-            )
+            receiver = cls.station_receiver(station)
+        return receiver
 
-        # TODO: Now that avatar_key is changable maybe update cache or clear it
-        # when avatar is changed
+    @classmethod
+    def user_receiver(cls, user_id, profile):
+        receiver = dict(profile)
+        receiver.update(id=user_id, is_station=False)
+        return receiver
 
-        # self.messages = [
-        #     Memcache.get_or_set_dict(
-        #         'messages-{}'.format(message.message_id),
-        #         self._to_message_response_dict, message
-        #     )
-        #     for message in reversed(messages)
-        # ]
+    @classmethod
+    def station_receiver(cls, station):
+        db = inject.instance('db')
+        members = Subscriber.get_members_for_station(db, station.station_id)
+        return {
+            "id": station.station_id,
+            "username": "Station",
+            "is_station": True,
+            "members": [StationMembers.to_dict(member) for member in members]
+        }
+
+    def to_dict(self):
+        return {
+            "receiver": self.receiver,
+            "unread": self.unread,
+            "messages": self.messages,
+            "cursors": {
+                "before": self.before,
+                "after": self.after
+            }
+        }
 
-        # for now, no caching
-        self.messages = [
-            MessageResponse(message).to_dict()
-            for message in reversed(messages)
-        ]
+
+class SyncResponse(object):
+    def __init__(
+        self, station_id, private_messages, station_messages,
+        station_unread, private_unreads, cursor, has_more
+    ):
+        self.station_id = station_id
+        senders = MessageResponse.load_senders(
+            private_messages + station_messages
+        )
+        self.private_messages = self._to_dicts(
+            private_messages, senders, is_station=False
+        )
+        self.station_messages = self._to_dicts(
+            station_messages, senders, is_station=True
+        )
+        self.unreads = {
+            "station": station_unread,
+            "private": [
+                {
+                    "sender_id": sender_id,
+                    "count": count
+                }
+                for sender_id, count in private_unreads.items()
+            ]
+        }
+        self.cursor = cursor
+        self.has_more = has_more
 
     @staticmethod
-    def _to_message_response_dict(message):
-        message_reponse = MessageResponse(message)
-        return message_reponse.to_dict()
+    def _to_dicts(messages, senders, is_station):
+        results = []
+        for message in messages:
+            result = MessageResponse(message, senders).to_dict()
+            result.update(is_station=is_station)
+            results.append(result)
+        return results
 
     def to_dict(self):
         return {
-            "receiver": self.receiver,
-            "unread": self.unread,
-            "messages": self.messages
+            "station_id": self.station_id,
+            "private_messages": self.private_messages,
+            "station_messages": self.station_messages,
+            "unreads": self.unreads,
+            "cursor": self.cursor,
+            "has_more": self.has_more
         }
@@ -1,10 +1,21 @@
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
 
 import inject
 import json
-from pywebpush import webpush, WebPushException
+from py_vapid import Vapid
+from pywebpush import WebPusher, WebPushException
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+from tornado import gen
+from tornado.ioloop import IOLoop
 
 from letsfuk import Config
+from letsfuk.db import transaction
 from letsfuk.db.models import PushNotification as DbPushNotification
 
 logger = logging.getLogger(__name__)
@@ -22,7 +33,94 @@ class SubscriberNotFound(Exception):
     pass
 
 
+class PushTransport(object):
+    """
+    Keep-alive session per push service origin, VAPID key parsed once
+    and signed headers reused per audience until they are about to expire.
+    """
+    content_encoding = 'aes128gcm'
+    claims_ttl = 12 * 60 * 60
+    claims_margin = 60 * 60
+    lock = threading.Lock()
+    sessions = {}
+    vapid = None
+    vapid_private_key = None
+    vapid_headers = {}
+
+    @classmethod
+    def get_origin(cls, endpoint):
+        url = urlparse(endpoint)
+        return "{}://{}".format(url.scheme, url.netloc)
+
+    @classmethod
+    def get_session(cls, origin):
+        with cls.lock:
+            session = cls.sessions.get(origin)
+            if session is None:
+                config = inject.instance(Config)
+                pool_size = config.get('push_workers', 4)
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=pool_size
+                )
+                session = Session()
+                session.mount(origin, adapter)
+                cls.sessions[origin] = session
+            return session
+
+    @classmethod
+    def get_vapid_headers(cls, audience):
+        config = inject.instance(Config)
+        vapid_private_key = config.get('vapid_private_key')
+        subject = 'mailto:{}'.format(config.get('vapid_mail'))
+        now = int(time.time())
+        with cls.lock:
+            if vapid_private_key != cls.vapid_private_key:
+                cls.vapid = Vapid.from_string(private_key=vapid_private_key)
+                cls.vapid_private_key = vapid_private_key
+                cls.vapid_headers = {}
+            cached = cls.vapid_headers.get((audience, subject))
+            if cached is not None:
+                expires_at, headers = cached
+                if now < expires_at - cls.claims_margin:
+                    return dict(headers)
+            expires_at = now + cls.claims_ttl
+            headers = cls.vapid.sign({
+                "aud": audience,
+                "exp": expires_at,
+                "sub": subject
+            })
+            cls.vapid_headers[(audience, subject)] = (expires_at, headers)
+            return dict(headers)
+
+    @classmethod
+    def send(cls, subscription_info, data, ttl=0, timeout=None):
+        endpoint = subscription_info.get('endpoint')
+        origin = cls.get_origin(endpoint)
+        encoded = WebPusher(subscription_info).encode(
+            data, cls.content_encoding
+        )
+        headers = cls.get_vapid_headers(origin)
+        headers.update({
+            'content-encoding': cls.content_encoding,
+            'ttl': str(ttl)
+        })
+        response = cls.get_session(origin).post(
+            endpoint, data=encoded.get('body'),
+            headers=headers, timeout=timeout
+        )
+        if response.status_code > 202:
+            raise WebPushException(
+                "Push failed: {} {}".format(
+                    response.status_code, response.reason
+                ),
+                response=response
+            )
+        return response
+
+
 class PushNotifications(object):
+    executor = None
+
     @classmethod
     def verify_params(cls, params):
         endpoint = params.get('endpoint')
@@ -79,38 +177,127 @@ class PushNotifications(object):
         _ = DbPushNotification.unsubscribe(db, subscriber)
 
     @classmethod
-    def send(cls, device_browser, data):
+    def get_executor(cls):
+        # webpush does blocking HTTP and encryption, keep it off the IOLoop
+        if cls.executor is None:
+            config = inject.instance(Config)
+            cls.executor = ThreadPoolExecutor(
+                max_workers=config.get('push_workers', 4),
+                thread_name_prefix='push'
+            )
+        return cls.executor
+
+    @classmethod
+    def get_retry_delay(cls, response, attempt):
+        config = inject.instance(Config)
+        backoff = config.get('push_retry_backoff', 1)
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            try:
+                return float(retry_after)
+            except (TypeError, ValueError) as _:
+                pass
+        return backoff * 2 ** attempt
+
+    @classmethod
+    def remove_subscription(cls, subscription_info):
+        db = inject.instance('db')
+        keys = subscription_info.get('keys')
+        device_browser = DbPushNotification.query_by_device_browser(
+            db, subscription_info.get('endpoint'),
+            keys.get('auth'), keys.get('p256dh')
+        )
+        if device_browser is not None:
+            # Runs on the IOLoop outside of any request, commit on its own
+            with transaction(db):
+                DbPushNotification.unsubscribe(db, device_browser)
+
+    @classmethod
+    def get_subscription_info(cls, device_browser):
         subscription_info = device_browser.to_dict()
         subscription_info.pop('user_id')
+        return subscription_info
+
+    @classmethod
+    async def send(cls, subscription_info, data):
         json_data = json.dumps(data)
         config = inject.instance(Config)
-        vapid_private_key = config.get('vapid_private_key')
-        email = config.get('vapid_mail')
-        try:
-            webpush(
-                subscription_info,
-                json_data,
-                vapid_private_key=vapid_private_key,
-                vapid_claims={"sub": 'mailto:{}'.format(email)}
-            )
-        except WebPushException as e:
-            if e.response.status_code == 410:
-                # Delete old subscription
-                db = inject.instance('db')
-                DbPushNotification.unsubscribe(db, device_browser)
+        max_retries = config.get('push_max_retries', 3)
+        send = partial(
+            PushTransport.send,
+            subscription_info,
+            json_data,
+            timeout=config.get('push_timeout', 10)
+        )
+        for attempt in range(max_retries + 1):
+            response = None
+            try:
+                await IOLoop.current().run_in_executor(
+                    cls.get_executor(), send
+                )
+                return True
+            except WebPushException as e:
+                response = e.response
+                status_code = None
+                if response is not None:
+                    status_code = response.status_code
+                if status_code == 410:
+                    # Delete old subscription
+                    cls.remove_subscription(subscription_info)
+                    return False
+                retryable = status_code is not None and (
+                    status_code == 429 or status_code >= 500
+                )
+                if not retryable or attempt == max_retries:
+                    logger.warning(
+                        "Push notification to {} failed: {}".format(
+                            subscription_info.get('endpoint'), e
+                        )
+                    )
+                    return False
+            except RequestException as e:
+                # Timeouts and connection errors
+                if attempt == max_retries:
+                    logger.warning(
+                        "Push notification to {} failed: {}".format(
+                            subscription_info.get('endpoint'), e
+                        )
+                    )
+                    return False
+            await gen.sleep(cls.get_retry_delay(response, attempt))
+        return False
 
     @classmethod
     def send_to_user(cls, user_id, data):
+        cls.send_to_users([(user_id, data)])
+
+    @classmethod
+    def send_to_users(cls, pushes):
+        """
+        Devices of every recipient are loaded with one query.
+        """
         db = inject.instance('db')
-        device_browsers = DbPushNotification.query_by_user_id(db, user_id)
+        device_browsers = DbPushNotification.query_by_user_ids(
+            db, {user_id for user_id, _ in pushes}
+        )
+        by_user = dict()
         for device_browser in device_browsers:
-            cls.send(device_browser, data)
-            logger.info(
-                "Sent push notification to "
-                "user_id: {}, device_browser: {}, data: {}".format(
-                    user_id, device_browser, data
-                )
+            # Plain values, rows expire on commit and may be gone by the
+            # time the send runs
+            by_user.setdefault(device_browser.user_id, []).append(
+                cls.get_subscription_info(device_browser)
             )
+        for user_id, data in pushes:
+            for subscription_info in by_user.get(user_id, []):
+                IOLoop.current().spawn_callback(
+                    cls.send, subscription_info, data
+                )
+                logger.info(
+                    "Sending push notification to "
+                    "user_id: {}, endpoint: {}, data: {}".format(
+                        user_id, subscription_info.get('endpoint'), data
+                    )
+                )
 
     @classmethod
     def check(cls, user, params):
@@ -129,3 +316,87 @@ class PushNotifications(object):
                 )
             )
         return subscriber
+
+
+class PushCoalescer(object):
+    """
+    First push to a user goes out right away and opens a window of
+    push_digest_window seconds, pushes arriving meanwhile are held and
+    sent as one digest when it closes.
+    """
+    pending = {}
+    outgoing = []
+    io_loop = None
+
+    @classmethod
+    def get_pending(cls):
+        io_loop = IOLoop.current()
+        # Windows are timers on the loop, tests get new loops
+        if cls.io_loop is not io_loop:
+            cls.pending = {}
+            cls.outgoing = []
+            cls.io_loop = io_loop
+        return cls.pending
+
+    @classmethod
+    def send(cls, user_id, data):
+        # Pushes of a whole station fan out, or of windows closing
+        # together, go out with one subscription query
+        _ = cls.get_pending()
+        cls.outgoing.append((user_id, data))
+        if len(cls.outgoing) == 1:
+            IOLoop.current().add_callback(cls.send_outgoing)
+
+    @classmethod
+    def send_outgoing(cls):
+        pushes, cls.outgoing = cls.outgoing, []
+        if len(pushes) == 0:
+            return
+        db = inject.instance('db')
+        with transaction(db):
+            PushNotifications.send_to_users(pushes)
+
+    @classmethod
+    def add(cls, user_id, data):
+        config = inject.instance(Config)
+        window = config.get('push_digest_window', 10)
+        if not window:
+            cls.send(user_id, data)
+            return
+        pending = cls.get_pending()
+        if user_id in pending:
+            pending[user_id].append(data)
+            return
+        pending[user_id] = []
+        cls.send(user_id, data)
+        IOLoop.current().call_later(window, cls.flush, user_id, window)
+
+    @classmethod
+    def flush(cls, user_id, window):
+        pending = cls.get_pending()
+        held = pending.pop(user_id, None)
+        if not held:
+            return
+        # Keep the window open while messages keep coming
+        pending[user_id] = []
+        IOLoop.current().call_later(window, cls.flush, user_id, window)
+        cls.send(user_id, cls.make_digest(held))
+
+    @classmethod
+    def make_digest(cls, held):
+        if len(held) == 1:
+            return held[0]
+        chats = set()
+        for data in held:
+            if data.get('is_station'):
+                chats.add(data.get('receiver_id'))
+            else:
+                chats.add(data.get('sender', dict()).get('user_id'))
+        return {
+            "is_digest": True,
+            "messages": len(held),
+            "chats": len(chats),
+            "text": "{} new messages from {} chats".format(
+                len(held), len(chats)
+            )
+        }
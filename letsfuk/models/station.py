@@ -3,8 +3,10 @@ import uuid
 import inject
 
 from letsfuk import Config
+from letsfuk.cache import StationMembers
 from letsfuk.db.models import Station as DbStation, User as DbUser, StationChat
 from letsfuk.db.models import Subscriber as DbSubscriber
+from letsfuk.db.models import ReadPointer, Unread
 
 
 class InvalidLatitude(Exception):
@@ -71,8 +73,38 @@ class Station(object):
     @classmethod
     def get_members(cls, station):
         db = inject.instance('db')
-        members = DbSubscriber.get_users_for_station(db, station.station_id)
-        return members
+        members = DbSubscriber.get_members_for_station(
+            db, station.station_id
+        )
+        return [StationMembers.to_dict(member) for member in members]
+
+    @classmethod
+    def is_pointer_mode(cls, station_id):
+        """
+        Big stations don't keep an unread counter per member, unread
+        messages are counted from member's read pointer instead.
+        """
+        config = inject.instance(Config)
+        threshold = config.get('unread_pointer_threshold')
+        if threshold is None:
+            return False
+        db = inject.instance('db')
+        return DbSubscriber.count_members(db, station_id) >= threshold
+
+    @classmethod
+    def rebuild_unreads(cls, station_id):
+        """
+        Counters were not bumped while the station was in pointer mode,
+        members' pointers say how many messages are still unread.
+        """
+        config = inject.instance(Config)
+        cap = config.get('unread_display_cap', 99)
+        db = inject.instance('db')
+        member_ids = DbSubscriber.get_member_ids(db, station_id)
+        counts = ReadPointer.count_unread_for_users(
+            db, station_id, member_ids, cap
+        )
+        Unread.set_for_station(db, station_id, counts)
 
     @classmethod
     def get_closest(cls, lat, lon):
@@ -100,6 +132,7 @@ class Station(object):
             db, message_id, station.station_id, user.user_id,
             god_text, None, god_sent_at
         )
+        DbStation.increment_message_count(db, station.station_id)
 
 
 class Subscriber(object):
@@ -114,8 +147,21 @@ class Subscriber(object):
             old_subscriber = DbSubscriber.get(
                 db, old_station.station_id, user.user_id
             )
+            was_pointer_mode = Station.is_pointer_mode(old_station.station_id)
             DbSubscriber.delete(db, old_subscriber)
+            if was_pointer_mode and not Station.is_pointer_mode(
+                    old_station.station_id
+            ):
+                Station.rebuild_unreads(old_station.station_id)
         subscriber = DbSubscriber.add(db, station.station_id, user.user_id)
+        # Station history is not unread for a new member, same as counters
+        # that start at zero
+        messages = StationChat.get(db, station.station_id, 0, 1)
+        if len(messages) > 0:
+            ReadPointer.move(
+                db, user.user_id, station.station_id,
+                messages[0].sent_at, messages[0].id
+            )
         return subscriber
 
     @classmethod
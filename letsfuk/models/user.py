@@ -4,7 +4,9 @@ import uuid
 import bcrypt
 import inject
 
-from letsfuk.db.models import User as DbUser
+from letsfuk.cache import UserProfiles
+from letsfuk.db import after_transaction
+from letsfuk.db.models import User as DbUser, Subscriber as DbSubscriber
 from letsfuk.models.s3 import S3Manager
 
 
@@ -136,6 +138,13 @@ class User(object):
         if user.avatar_key:
             S3Manager.delete(user.avatar_key)
         user = DbUser.update_avatar(db, user, avatar_key)
+        # Bumped once transaction ends, sooner and others could cache
+        # the old avatar under the new version
+        after_transaction(db, UserProfiles.bump, user_id)
+        # Cached station members carry avatar keys
+        station = DbSubscriber.get_station_for_user(db, user_id)
+        if station is not None:
+            DbSubscriber.invalidate_members(db, station.station_id)
         return user
 
     @classmethod
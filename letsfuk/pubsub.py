@@ -0,0 +1,174 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy.exc import DBAPIError
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryPubSub(object):
+    """
+    Single process, published payloads are handed to subscribers
+    right away.
+    """
+    cross_process = False
+    max_payload = None
+
+    def __init__(self):
+        self.callbacks = dict()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def subscribe(self, channel, callback):
+        self.callbacks.setdefault(channel, []).append(callback)
+
+    def publish(self, channel, payload):
+        for callback in self.callbacks.get(channel, []):
+            callback(payload)
+
+
+class PostgresPubSub(MemoryPubSub):
+    """
+    Payloads go through Postgres LISTEN/NOTIFY so every process gets them,
+    this one included. Publishing never blocks the IOLoop, payloads are
+    sent in batches from a worker thread.
+    """
+    cross_process = True
+    # NOTIFY payload has to be shorter than 8000 bytes
+    max_payload = 7999
+    reconnect_delay = 1
+
+    def __init__(self, engine):
+        super(PostgresPubSub, self).__init__()
+        self.engine = engine
+        self.connection = None
+        self.fd = None
+        # One thread keeps notifications in the order they were published
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.flushing = False
+
+    def start(self):
+        self.connect()
+
+    def stop(self):
+        if self.connection is not None:
+            IOLoop.current().remove_handler(self.fd)
+            self.connection.close()
+            self.connection = None
+
+    def connect(self):
+        try:
+            # Own connection outside of the pool, it stays in LISTEN forever
+            raw_connection = self.engine.raw_connection()
+            raw_connection.detach()
+            self.connection = raw_connection.connection
+            self.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            for channel in self.callbacks:
+                self.listen(channel)
+        except (DBAPIError, psycopg2.Error) as e:
+            logger.exception("Listening connection failed: {}".format(e))
+            self.reconnect()
+            return
+        # Closed connection has no fileno, handler is removed by fd
+        self.fd = self.connection.fileno()
+        IOLoop.current().add_handler(self.fd, self.on_notify, IOLoop.READ)
+
+    def reconnect(self):
+        if self.connection is not None:
+            if self.fd is not None:
+                IOLoop.current().remove_handler(self.fd)
+            try:
+                self.connection.close()
+            except psycopg2.Error as _:
+                pass
+        self.connection = None
+        self.fd = None
+        # Notifications sent meanwhile are lost, unacked deliveries
+        # end up as push notifications
+        IOLoop.current().call_later(self.reconnect_delay, self.connect)
+
+    def listen(self, channel):
+        cursor = self.connection.cursor()
+        cursor.execute('LISTEN "{}"'.format(channel))
+        cursor.close()
+
+    def subscribe(self, channel, callback):
+        if channel not in self.callbacks and self.connection is not None:
+            self.listen(channel)
+        super(PostgresPubSub, self).subscribe(channel, callback)
+
+    def publish(self, channel, payload):
+        self.pending.append((channel, payload))
+        if not self.flushing:
+            self.flushing = True
+            IOLoop.current().add_callback(self.flush)
+
+    async def flush(self):
+        # Everything published until the IOLoop got control back goes
+        # out in one round trip
+        while len(self.pending) > 0:
+            notifications, self.pending = self.pending, []
+            try:
+                await IOLoop.current().run_in_executor(
+                    self.executor, self.notify, notifications
+                )
+            except Exception as e:
+                logger.exception(
+                    "Publishing {} notifications failed: {}".format(
+                        len(notifications), e
+                    )
+                )
+        self.flushing = False
+
+    def notify(self, notifications):
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                'SELECT pg_notify(channel, payload) '
+                'FROM unnest(%s::text[], %s::text[]) '
+                'AS notifications(channel, payload)',
+                (
+                    [channel for channel, _ in notifications],
+                    [payload for _, payload in notifications]
+                )
+            )
+            cursor.close()
+            connection.commit()
+        finally:
+            connection.close()
+
+    def on_notify(self, fd, events):
+        try:
+            self.connection.poll()
+        except psycopg2.Error as e:
+            logger.exception("Listening connection lost: {}".format(e))
+            self.reconnect()
+            return
+        while self.connection.notifies:
+            notify = self.connection.notifies.pop(0)
+            try:
+                super(PostgresPubSub, self).publish(
+                    notify.channel, notify.payload
+                )
+            except Exception as e:
+                logger.exception(
+                    "Handling notification on {} failed: {}".format(
+                        notify.channel, e
+                    )
+                )
+
+
+def make_pubsub(config, engine):
+    backend = config.get('pubsub_backend', 'memory')
+    if backend == 'postgres':
+        return PostgresPubSub(engine)
+    return MemoryPubSub()
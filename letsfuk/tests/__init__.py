@@ -1,3 +1,4 @@
+import json
 import uuid
 from random import choice, uniform, random
 
@@ -6,14 +7,16 @@ from math import sqrt
 from datetime import datetime, timedelta
 
 import letsfuk
+from tornado import gen
 from tornado.testing import AsyncHTTPTestCase
+from tornado.websocket import websocket_connect
 
 from letsfuk import Config
 from letsfuk.models.user import User as UserModel
 from letsfuk.db import Base, commit
 from letsfuk.db.models import (
     Station, Subscriber, PrivateChat, StationChat,
-    PushNotification, User, Session, Unread
+    PushNotification, User, Session, Unread, Conversation, ReadPointer
 )
 from letsfuk.ioc import testing_configuration
 
@@ -111,9 +114,42 @@ generator_pool = GeneratorPool()
 
 
 class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
+    # Config keys a test case changes, restored after every test
+    config_keys = []
+
     def setUp(self):
         super(BaseAsyncHTTPTestCase, self).setUp()
         self.generator = generator_pool
+        config = inject.instance(Config)
+        self.old_config = {
+            key: config.data[key]
+            for key in self.config_keys
+            if key in config.data
+        }
+
+    def tearDown(self):
+        config = inject.instance(Config)
+        for key in self.config_keys:
+            config.data.pop(key, None)
+        config.data.update(self.old_config)
+        super(BaseAsyncHTTPTestCase, self).tearDown()
+
+    async def connect(self, user_id, acks=False):
+        url = self.get_url('/websocket').replace('http', 'ws', 1)
+        web_socket = await websocket_connect(url)
+        web_socket.write_message(json.dumps({
+            "event": "connect",
+            "data": {"id": user_id, "acks": acks}
+        }))
+        # Let the server register the socket
+        await gen.sleep(0.05)
+        return web_socket
+
+    async def wait_for_received(self, received, count, timeout=5):
+        waited = 0
+        while len(received) < count and waited < timeout:
+            await gen.sleep(0.05)
+            waited += 0.05
 
     def get_app(self):
         return letsfuk.make_app()
@@ -129,6 +165,7 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
         db = inject.instance('db')
         user_id = str(uuid.uuid4())
         user = User.add(db, user_id, username, email, bcrypted_password)
+        commit(db)
         if station is not None:
             _ = self.subscribe(station.station_id, user.user_id)
         return user
@@ -148,6 +185,7 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
         session = Session.add(
             db, session_id, registered_user.user_id, expires_at
         )
+        commit(db)
         if station is None:
             station = self.add_station()
         _ = self.subscribe(station.station_id, registered_user.user_id)
@@ -161,6 +199,7 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
         db = inject.instance('db')
         station_id = str(uuid.uuid4())
         station = Station.add(db, station_id, lat, lon)
+        commit(db)
         return station
 
     def ensure_one_station(self):
@@ -187,6 +226,10 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
         for unread in unreads:
             db.delete(unread)
             commit(db)
+        pointers = db.query(ReadPointer).all()
+        for pointer in pointers:
+            db.delete(pointer)
+            commit(db)
         for sc in scs:
             db.delete(sc)
             commit(db)
@@ -231,6 +274,7 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
     def subscribe(self, station_id, user_id):
         db = inject.instance('db')
         subscriber = Subscriber.add(db, station_id, user_id)
+        commit(db)
         return subscriber
 
     def add_private_message(self, sender_id, receiver_id):
@@ -250,6 +294,8 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
             message = PrivateChat.add(
                 db, message_id, receiver_id, sender_id, None, text, now
             )
+        _ = Conversation.add_message(db, message)
+        commit(db)
         return message
 
     def add_group_message(self, sender_id, receiver_id):
@@ -269,6 +315,8 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
             message = StationChat.add(
                 db, message_id, receiver_id, sender_id, None, text, now
             )
+        Station.increment_message_count(db, receiver_id)
+        commit(db)
         return message
 
     def make_station_chat(self, station, users=None):
@@ -322,6 +370,7 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
         unread = Unread.add(
             db, receiver_id, station_id=station_id, sender_id=sender_id
         )
+        commit(db)
         return unread
 
     def assertUserWithUsername(self, username):
@@ -343,6 +392,7 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
         subscriber = PushNotification.subscribe(
             db, user.user_id, endpoint, auth, p256dh
         )
+        commit(db)
         return subscriber, session, user
 
     def ensure_avatar(self, user_id, avatar_key=None):
@@ -352,4 +402,5 @@ class BaseAsyncHTTPTestCase(AsyncHTTPTestCase):
             random_uuid = self.generator.uuid.generate()
             avatar_key = "{}/{}".format(user.username, random_uuid)
         user = User.update_avatar(db, user, avatar_key)
+        commit(db)
         return user
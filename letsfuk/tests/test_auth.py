@@ -334,6 +334,32 @@ class TestAuth(BaseAsyncHTTPTestCase):
         text = response_body.get('text')
         self.assertAlmostEqual("Your session is expired", text)
 
+    def test_expired_session_deleted(self):
+        import inject
+        import time
+        from letsfuk import Config
+        from letsfuk.db.models import Session
+        session_ttl_seconds = 2
+        config = inject.instance(Config)
+        old_session_ttl = config.get('session_ttl')
+        config.set('session_ttl', session_ttl_seconds)
+        session, _ = self.ensure_login()
+        config.set('session_ttl', old_session_ttl)
+        session_id = session.session_id
+        time.sleep(session_ttl_seconds + 1)
+        response = self.fetch(
+            '/whoami',
+            method="GET",
+            headers={
+                "session-id": session_id
+            }
+        )
+        self.assertEqual(response.code, 401)
+        # Deletion must survive the rollback of the failed request
+        db = inject.instance('db')
+        db.rollback()
+        self.assertIsNone(Session.query_by_session_id(db, session_id))
+
     def test_session_id_regex_fail(self):
         response = self.fetch(
             '/whoami',
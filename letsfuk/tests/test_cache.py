@@ -0,0 +1,133 @@
+import json
+import time
+
+import inject
+
+from letsfuk.cache import Memcache, StationMembers, UserProfiles
+from letsfuk.db import commit
+from letsfuk.db.models import Subscriber, Unread
+from letsfuk.tests import BaseAsyncHTTPTestCase
+
+
+class MemcacheStandIn(object):
+    """Plays memcache client, keeps values in a dict."""
+    def __init__(self):
+        self.values = dict()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def get_many(self, keys):
+        return {key: self.values[key] for key in keys if key in self.values}
+
+    def set_many(self, values):
+        self.values.update(values)
+
+    def delete(self, key):
+        _ = self.values.pop(key, None)
+
+
+class TestCache(BaseAsyncHTTPTestCase):
+    def setUp(self):
+        super(TestCache, self).setUp()
+        self.old_memcache = Memcache.memcache
+        Memcache.memcache = MemcacheStandIn()
+        self.old_ttl = StationMembers.ttl
+        StationMembers.members = dict()
+
+    def tearDown(self):
+        Memcache.memcache = self.old_memcache
+        StationMembers.ttl = self.old_ttl
+        StationMembers.members = dict()
+        super(TestCache, self).tearDown()
+
+    def test_profile_served_from_cache(self):
+        user = self.ensure_register()
+        loads = []
+
+        def load(user_ids):
+            loads.append(user_ids)
+            return {user_id: {"user_id": user_id} for user_id in user_ids}
+        for _ in range(2):
+            profiles = UserProfiles.get_many([user.user_id], load)
+            self.assertEqual(
+                profiles, {user.user_id: {"user_id": user.user_id}}
+            )
+        self.assertEqual(loads, [[user.user_id]])
+
+    def test_avatar_update_shows_in_chat(self):
+        station = self.add_station()
+        session, user = self.ensure_login(station=station)
+        _ = self.add_group_message(user.user_id, station.station_id)
+
+        def get_sender():
+            response = self.fetch(
+                '/messages/{}'.format(station.station_id),
+                method="GET",
+                headers={
+                    "session-id": session.session_id
+                }
+            )
+            self.assertEqual(response.code, 200)
+            messages = json.loads(response.body.decode()).get('messages')
+            return messages[0].get('sender')
+        self.assertIsNone(get_sender().get('avatar_key'))
+        avatar_key = "{}/{}".format(
+            user.username, self.generator.uuid.generate()
+        )
+        response = self.fetch(
+            '/users/{}'.format(user.user_id),
+            method="PATCH",
+            body=json.dumps({"avatar_key": avatar_key}).encode('utf-8'),
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(get_sender().get('avatar_key'), avatar_key)
+
+    def test_station_members_expire_in_process(self):
+        StationMembers.ttl = 0.1
+        station = self.add_station()
+        loads = []
+
+        def load():
+            loads.append(station.station_id)
+            return [["user_id", "username", "email", None]]
+        _ = StationMembers.get_or_set(station.station_id, load)
+        # Drop second tier so only the in process copy can answer
+        Memcache.memcache.delete(StationMembers.key(station.station_id))
+        _ = StationMembers.get_or_set(station.station_id, load)
+        self.assertEqual(len(loads), 1)
+        time.sleep(0.2)
+        _ = StationMembers.get_or_set(station.station_id, load)
+        self.assertEqual(len(loads), 2)
+
+    def test_station_message_reaches_member_missing_from_cache(self):
+        station = self.add_station()
+        session, user = self.ensure_login(station=station)
+        db = inject.instance('db')
+        _ = Subscriber.get_members_for_station(db, station.station_id)
+        # Joined through another process, this one's copy is stale
+        another_user = self.ensure_register()
+        db.add(Subscriber(
+            station_id=station.station_id, user_id=another_user.user_id
+        ))
+        commit(db)
+        response = self.fetch(
+            '/messages',
+            method="POST",
+            body=json.dumps({"text": "Hi"}).encode('utf-8'),
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        unread = Unread.get(
+            db, another_user.user_id, station_id=station.station_id
+        )
+        self.assertIsNotNone(unread)
+        self.assertEqual(unread.count, 1)
@@ -0,0 +1,37 @@
+import inject
+
+from letsfuk.db import (
+    commit, transaction, after_commit, after_transaction
+)
+from letsfuk.tests import BaseAsyncHTTPTestCase
+
+
+class TestTransaction(BaseAsyncHTTPTestCase):
+    def test_callbacks_run_after_commit(self):
+        db = inject.instance('db')
+        committed = []
+        ended = []
+        with transaction(db):
+            after_commit(db, committed.append, 'delivered')
+            after_transaction(db, ended.append, 'invalidated')
+            self.assertEqual(committed, [])
+            self.assertEqual(ended, [])
+        self.assertEqual(committed, ['delivered'])
+        self.assertEqual(ended, ['invalidated'])
+
+    def test_callbacks_after_rollback(self):
+        db = inject.instance('db')
+        committed = []
+        ended = []
+        try:
+            with transaction(db):
+                after_commit(db, committed.append, 'delivered')
+                after_transaction(db, ended.append, 'invalidated')
+                raise ValueError("Handler failed")
+        except ValueError as _:
+            pass
+        self.assertEqual(ended, ['invalidated'])
+        # Rolled back callbacks must not leak into the next commit
+        commit(db)
+        self.assertEqual(committed, [])
+        self.assertEqual(ended, ['invalidated'])
@@ -1,7 +1,21 @@
 import json
+from threading import Thread
 
-from datetime import datetime
+import inject
+import letsfuk
+from datetime import datetime, timedelta
+from urllib.parse import quote
 
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from letsfuk import Config
+from letsfuk.db import commit
+from letsfuk.db.models import (
+    Unread, PrivateChat, StationChat, ReadPointer, Subscriber, Conversation
+)
+from letsfuk.delivery import DeliveryQueue
+from letsfuk.handlers.websocket import BroadcastFrame
 from letsfuk.tests import BaseAsyncHTTPTestCase
 
 
@@ -62,6 +76,148 @@ class TestMessages(BaseAsyncHTTPTestCase):
         sender_response = response_body.get('sender')
         self.assertEqual(user.user_id, sender_response.get('user_id'))
 
+    def test_add_message_to_station_unreads(self):
+        session, user, station = self.prepare_for_sending_message_to_station()
+        members = [self.ensure_register(station=station) for _ in range(3)]
+        for _ in range(2):
+            body = {
+                "text": self.generator.text.generate()
+            }
+            response = self.fetch(
+                '/messages',
+                method="POST",
+                body=json.dumps(body).encode('utf-8'),
+                headers={
+                    "session-id": session.session_id
+                }
+            )
+            self.assertEqual(response.code, 200)
+        db = inject.instance('db')
+        for member in members:
+            unread = Unread.get(
+                db, member.user_id, station_id=station.station_id
+            )
+            self.assertEqual(unread.count, 2)
+        unread = Unread.get(db, user.user_id, station_id=station.station_id)
+        self.assertIsNone(unread)
+
+    def test_add_message_to_user_unreads(self):
+        session, user, receiver, _ = self.prepare_for_sending_message_to_user()
+        for _ in range(3):
+            body = {
+                "text": self.generator.text.generate(),
+                "user_id": receiver.user_id
+            }
+            response = self.fetch(
+                '/messages',
+                method="POST",
+                body=json.dumps(body).encode('utf-8'),
+                headers={
+                    "session-id": session.session_id
+                }
+            )
+            self.assertEqual(response.code, 200)
+        db = inject.instance('db')
+        unreads = db.query(Unread).filter(
+            Unread.receiver_id == receiver.user_id,
+            Unread.sender_id == user.user_id
+        ).all()
+        self.assertEqual(len(unreads), 1)
+        self.assertEqual(unreads[0].count, 3)
+
+    def send_batch(self, session, messages):
+        response = self.fetch(
+            '/messages/batch',
+            method="POST",
+            body=json.dumps({"messages": messages}).encode('utf-8'),
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        return response
+
+    def test_add_message_batch(self):
+        session, user, receiver, station = (
+            self.prepare_for_sending_message_to_user()
+        )
+        texts = [self.generator.text.generate() for _ in range(3)]
+        messages = [
+            {"text": texts[0], "user_id": receiver.user_id},
+            {"text": texts[1], "user_id": receiver.user_id},
+            {"text": texts[2]},
+            {"text": ""},
+            {"text": texts[0], "user_id": self.generator.uuid.generate()}
+        ]
+        response = self.send_batch(session, messages)
+        self.assertEqual(response.code, 200)
+        results = json.loads(response.body.decode()).get('results')
+        self.assertEqual(
+            [result.get('status_code') for result in results],
+            [200, 200, 200, 400, 404]
+        )
+        self.assertEqual(
+            [result.get('message').get('text') for result in results[:3]],
+            texts
+        )
+        db = inject.instance('db')
+        unread = Unread.get(db, receiver.user_id, sender_id=user.user_id)
+        self.assertEqual(unread.count, 2)
+        unread = Unread.get(
+            db, receiver.user_id, station_id=station.station_id
+        )
+        self.assertEqual(unread.count, 1)
+        response = self.fetch(
+            '/messages/{}'.format(receiver.user_id),
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        chat = json.loads(response.body.decode())
+        # Page is rendered oldest first, batch order is kept
+        self.assertEqual(
+            [message.get('text') for message in chat.get('messages')],
+            [texts[0], texts[1]]
+        )
+
+    def test_add_message_batch_too_large(self):
+        session, user, receiver, _ = self.prepare_for_sending_message_to_user()
+        config = inject.instance(Config)
+        batch_limit = config.get('message_batch_limit', 50)
+        messages = [
+            {"text": self.generator.text.generate()}
+            for _ in range(batch_limit + 1)
+        ]
+        response = self.send_batch(session, messages)
+        self.assertEqual(response.code, 400)
+        response = self.send_batch(session, [])
+        self.assertEqual(response.code, 400)
+
+    def test_add_message_delivered_after_response(self):
+        session, user, receiver, _ = self.prepare_for_sending_message_to_user()
+        delivered = DeliveryQueue.metrics().get('delivered')
+        body = {
+            "text": self.generator.text.generate(),
+            "user_id": receiver.user_id
+        }
+        response = self.fetch(
+            '/messages',
+            method="POST",
+            body=json.dumps(body).encode('utf-8'),
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        delivery = DeliveryQueue.metrics()
+        self.assertEqual(delivery.get('depth'), 0)
+        self.assertEqual(delivery.get('delivered'), delivered + 1)
+
+    def test_metrics_not_public(self):
+        response = self.fetch('/metrics', method="GET")
+        self.assertEqual(response.code, 404)
+
     def test_add_image_message_to_station(self):
         session, user, station = self.prepare_for_sending_message_to_station()
         text = self.generator.text.generate()
@@ -235,6 +391,24 @@ class TestMessages(BaseAsyncHTTPTestCase):
                 str(message.sent_at), response_message.get('sent_at')
             )
 
+    def test_get_private_chat_total(self):
+        station = self.add_station()
+        session, user = self.ensure_login(station=station)
+        _, another_user = self.ensure_login(station=station)
+        _, third_user = self.ensure_login(station=station)
+        messages = self.make_private_chat(user, another_user)
+        _ = self.make_private_chat(user, third_user)
+        response = self.fetch(
+            '/messages/{}'.format(another_user.user_id),
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        total = int(response.headers.get('x-total'))
+        self.assertEqual(total, len(messages))
+
     def test_chat_default_limit_offset(self):
         station = self.add_station()
         session, user = self.ensure_login(station=station)
@@ -351,6 +525,71 @@ class TestMessages(BaseAsyncHTTPTestCase):
                 str(message.sent_at), response_message.get('sent_at')
             )
 
+    def test_chat_before_cursor(self):
+        station = self.add_station()
+        session, user = self.ensure_login(station=station)
+        _, another_user = self.ensure_login(station=station)
+        _ = self.make_private_chat(user, another_user)
+        limit = 5
+        response = self.fetch(
+            '/messages/{}?limit={}'.format(another_user.user_id, limit),
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        response_body = json.loads(response.body.decode())
+        before = response_body.get('cursors').get('before')
+        self.assertIsNotNone(before)
+        response = self.fetch(
+            '/messages/{}?before={}&limit={}'.format(
+                another_user.user_id, quote(before), limit
+            ),
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        cursor_messages = json.loads(
+            response.body.decode()
+        ).get('messages')
+        response = self.fetch(
+            '/messages/{}?offset={}&limit={}'.format(
+                another_user.user_id, limit, limit
+            ),
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        offset_messages = json.loads(
+            response.body.decode()
+        ).get('messages')
+        self.assertEqual(len(cursor_messages), limit)
+        self.assertEqual(
+            [message.get('message_id') for message in offset_messages],
+            [message.get('message_id') for message in cursor_messages]
+        )
+
+    def test_chat_invalid_cursor(self):
+        station = self.add_station()
+        session, user = self.ensure_login(station=station)
+        _, another_user = self.ensure_login(station=station)
+        _ = self.make_private_chat(user, another_user)
+        response = self.fetch(
+            '/messages/{}?before={}'.format(
+                another_user.user_id, 'random'
+            ),
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 400)
+
     def test_chat_unauthorized(self):
         station = self.add_station()
         session, user = self.ensure_login(station=station)
@@ -417,6 +656,38 @@ class TestMessages(BaseAsyncHTTPTestCase):
         )
         self.assertEqual(response.code, 404)
 
+    def test_get_chats_queries_do_not_grow_with_chats(self):
+        station = self.add_station()
+        session, user = self.ensure_login(station=station)
+        engine = inject.instance('db_engine')
+
+        def count_queries():
+            statements = []
+
+            def on_execute(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(engine, 'before_cursor_execute', on_execute)
+            try:
+                response = self.fetch(
+                    '/messages?offset=0&limit=10',
+                    method="GET",
+                    headers={
+                        "session-id": session.session_id
+                    }
+                )
+            finally:
+                event.remove(engine, 'before_cursor_execute', on_execute)
+            self.assertEqual(response.code, 200)
+            return len(statements)
+        for _ in range(2):
+            partner = self.ensure_register(station=station)
+            _ = self.add_private_message(partner.user_id, user.user_id)
+        queries = count_queries()
+        for _ in range(3):
+            partner = self.ensure_register(station=station)
+            _ = self.add_private_message(partner.user_id, user.user_id)
+        self.assertEqual(count_queries(), queries)
+
     def test_get_chats(self):
         session, station_chat, private_chats = self.make_chats()
         offset, limit = 0, 10
@@ -473,6 +744,66 @@ class TestMessages(BaseAsyncHTTPTestCase):
                     str(message.sent_at), response_message.get('sent_at')
                 )
 
+    def test_get_chats_after_sending_message(self):
+        session, user, receiver, _ = self.prepare_for_sending_message_to_user()
+        text = self.generator.text.generate()
+        body = {
+            "text": text,
+            "user_id": receiver.user_id
+        }
+        response = self.fetch(
+            '/messages',
+            method="POST",
+            body=json.dumps(body).encode('utf-8'),
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        response = self.fetch(
+            '/messages',
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        total = int(response.headers.get('x-total'))
+        # Plus one because of station chat
+        self.assertEqual(total, 2)
+        response_body = json.loads(response.body.decode())
+        response_private_chats = response_body.get('private_chats')
+        self.assertEqual(len(response_private_chats), 1)
+        response_chat = response_private_chats[0]
+        receiver_response = response_chat.get('receiver')
+        self.assertEqual(receiver.user_id, receiver_response.get('id'))
+        response_messages = response_chat.get('messages')
+        self.assertEqual(len(response_messages), 1)
+        self.assertEqual(text, response_messages[0].get('text'))
+
+    def test_get_chats_unreads(self):
+        station = self.add_station()
+        session, user = self.ensure_login(station=station)
+        _, another_user = self.ensure_login(station=station)
+        _ = self.make_private_chat(user, another_user)
+        for _ in range(3):
+            self.ensure_unreads(user.user_id, sender_id=another_user.user_id)
+        self.ensure_unreads(user.user_id, station_id=station.station_id)
+        response = self.fetch(
+            '/messages',
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        response_body = json.loads(response.body.decode())
+        station_chat = response_body.get('station_chat')
+        self.assertEqual(station_chat.get('unread'), 1)
+        private_chats = response_body.get('private_chats')
+        self.assertEqual(len(private_chats), 1)
+        self.assertEqual(private_chats[0].get('unread'), 3)
+
     def test_get_chats_unauthorized(self):
         _, station_chat, private_chats = self.make_chats()
         offset, limit = 0, 10
@@ -482,6 +813,100 @@ class TestMessages(BaseAsyncHTTPTestCase):
         )
         self.assertEqual(response.code, 401)
 
+    def sync(self, session, cursor=None):
+        url = '/messages/sync'
+        if cursor is not None:
+            url = '{}?since={}'.format(url, quote(cursor))
+        response = self.fetch(
+            url,
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body.decode())
+
+    def test_sync(self):
+        station = self.add_station()
+        session, user = self.ensure_login(station=station)
+        _, another_user = self.ensure_login(station=station)
+        _ = self.make_private_chat(user, another_user)
+        _ = self.make_station_chat(station, [user, another_user])
+        response_body = self.sync(session)
+        self.assertEqual(response_body.get('private_messages'), [])
+        self.assertEqual(response_body.get('station_messages'), [])
+        cursor = response_body.get('cursor')
+        self.assertIsNotNone(cursor)
+        private_message = self.add_private_message(
+            another_user.user_id, user.user_id
+        )
+        station_message = self.add_group_message(
+            another_user.user_id, station.station_id
+        )
+        self.ensure_unreads(user.user_id, sender_id=another_user.user_id)
+        response_body = self.sync(session, cursor)
+        private_messages = response_body.get('private_messages')
+        self.assertEqual(len(private_messages), 1)
+        self.assertEqual(
+            private_message.message_id, private_messages[0].get('message_id')
+        )
+        station_messages = response_body.get('station_messages')
+        self.assertEqual(len(station_messages), 1)
+        self.assertEqual(
+            station_message.message_id, station_messages[0].get('message_id')
+        )
+        private_unreads = response_body.get('unreads').get('private')
+        self.assertEqual(private_unreads, [{
+            "sender_id": another_user.user_id,
+            "count": 1
+        }])
+        self.assertFalse(response_body.get('has_more'))
+        response_body = self.sync(session, response_body.get('cursor'))
+        self.assertEqual(response_body.get('private_messages'), [])
+        self.assertEqual(response_body.get('station_messages'), [])
+
+    def test_sync_unread_reset_and_station_change(self):
+        station = self.add_station()
+        another_station = self.add_station()
+        session, user = self.ensure_login(station=station)
+        _, another_user = self.ensure_login(station=station)
+        self.ensure_unreads(user.user_id, sender_id=another_user.user_id)
+        cursor = self.sync(session).get('cursor')
+        db = inject.instance('db')
+        # Read on another device, no new message in the chat
+        Unread.reset(db, user.user_id, sender_id=another_user.user_id)
+        commit(db)
+        _ = self.add_group_message(
+            another_user.user_id, another_station.station_id
+        )
+        subscriber = Subscriber.get(db, station.station_id, user.user_id)
+        Subscriber.delete(db, subscriber)
+        commit(db)
+        _ = self.subscribe(another_station.station_id, user.user_id)
+        response_body = self.sync(session, cursor)
+        private_unreads = response_body.get('unreads').get('private')
+        self.assertEqual(private_unreads, [{
+            "sender_id": another_user.user_id,
+            "count": 0
+        }])
+        # New station is loaded by client, its history is not replayed
+        self.assertEqual(
+            response_body.get('station_id'), another_station.station_id
+        )
+        self.assertEqual(response_body.get('station_messages'), [])
+
+    def test_sync_invalid_cursor(self):
+        session, _, _ = self.prepare_for_sending_message_to_station()
+        response = self.fetch(
+            '/messages/sync?since=random',
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 400)
+
     def test_reset_unread_messages_for_station(self):
         station = self.add_station()
         session, user = self.ensure_login(station=station)
@@ -525,3 +950,215 @@ class TestMessages(BaseAsyncHTTPTestCase):
         self.assertEqual(response.code, 200)
         response_body = json.loads(response.body.decode())
         self.assertEqual(response_body.get('count'), 0)
+
+    def reset_station_unread(self, session, user, station, count):
+        body = {
+            "count": count,
+            "receiver_id": user.user_id,
+            "station_id": station.station_id
+        }
+        response = self.fetch(
+            '/messages/unreads/reset',
+            method="PUT",
+            body=json.dumps(body).encode('utf-8'),
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        response_body = json.loads(response.body.decode())
+        return response_body.get('count')
+
+    def get_station_unread(self, session, station):
+        response = self.fetch(
+            '/messages/{}'.format(station.station_id),
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        response_body = json.loads(response.body.decode())
+        return response_body.get('unread')
+
+    def test_station_unread_pointer_mode(self):
+        config = inject.instance(Config)
+        config.data['unread_pointer_threshold'] = 1
+        try:
+            station = self.add_station()
+            session, user = self.ensure_login(station=station)
+            another_user = self.ensure_register(station=station)
+            for _ in range(3):
+                self.add_group_message(
+                    another_user.user_id, station.station_id
+                )
+            self.assertEqual(self.get_station_unread(session, station), 3)
+            count = self.reset_station_unread(session, user, station, 0)
+            self.assertEqual(count, 0)
+            self.assertEqual(self.get_station_unread(session, station), 0)
+            for _ in range(2):
+                self.add_group_message(
+                    another_user.user_id, station.station_id
+                )
+            self.assertEqual(self.get_station_unread(session, station), 2)
+            count = self.reset_station_unread(session, user, station, 1)
+            self.assertEqual(count, 1)
+        finally:
+            config.data.pop('unread_pointer_threshold')
+
+    def test_pointer_counts_messages_sent_at_same_time(self):
+        station = self.add_station()
+        user = self.ensure_register(station=station)
+        another_user = self.ensure_register(station=station)
+        db = inject.instance('db')
+        sent_at = datetime.utcnow()
+        for _ in range(3):
+            StationChat.add(
+                db, self.generator.uuid.generate(), station.station_id,
+                another_user.user_id, self.generator.text.generate(), None,
+                sent_at
+            )
+        commit(db)
+        # Pointer lands between messages with equal sent_at
+        ReadPointer.move_to_unread(db, user.user_id, station.station_id, 1)
+        commit(db)
+        count = ReadPointer.count_unread(
+            db, user.user_id, station.station_id, 99
+        )
+        self.assertEqual(count, 1)
+        # Own messages are not unread, without pointer the rest are
+        third_user = self.ensure_register(station=station)
+        counts = ReadPointer.count_unread_for_users(
+            db, station.station_id,
+            [user.user_id, another_user.user_id, third_user.user_id], 2
+        )
+        self.assertEqual(counts, {
+            user.user_id: 1,
+            another_user.user_id: 0,
+            third_user.user_id: 2
+        })
+
+    def test_broadcast_frame(self):
+        data = {
+            "is_station": True,
+            "text": self.generator.text.generate()
+        }
+        frame = BroadcastFrame('message', data)
+        for unread in [None, 0, 7]:
+            rendered = json.loads(frame.render({"unread": unread}))
+            self.assertEqual(rendered.get('event'), 'message')
+            self.assertEqual(
+                rendered.get('data'), dict(data, unread=unread)
+            )
+        self.assertEqual(
+            json.loads(frame.render()), {"event": "message", "data": data}
+        )
+        empty = BroadcastFrame('message', dict())
+        self.assertEqual(
+            json.loads(empty.render({"unread": 1})),
+            {"event": "message", "data": {"unread": 1}}
+        )
+
+    def test_get_latest_for_partners(self):
+        station = self.add_station()
+        user = self.ensure_register(station=station)
+        another_user = self.ensure_register(station=station)
+        third_user = self.ensure_register(station=station)
+        db = inject.instance('db')
+        now = datetime.utcnow()
+
+        def add(sender, receiver, sent_at):
+            return PrivateChat.add(
+                db, self.generator.uuid.generate(), receiver.user_id,
+                sender.user_id, self.generator.text.generate(), None, sent_at
+            )
+        first = add(user, another_user, now)
+        latest_received = add(another_user, user, now + timedelta(seconds=1))
+        sent = add(user, third_user, now + timedelta(seconds=2))
+        # Same sent_at, later row wins
+        latest_tied = add(third_user, user, now + timedelta(seconds=2))
+        _ = add(another_user, third_user, now + timedelta(seconds=3))
+        commit(db)
+        partner_ids = [another_user.user_id, third_user.user_id]
+        chats = PrivateChat.get_latest_for_partners(
+            db, user.user_id, partner_ids, 1
+        )
+        self.assertEqual(
+            [message.message_id for message in chats[another_user.user_id]],
+            [latest_received.message_id]
+        )
+        self.assertEqual(
+            [message.message_id for message in chats[third_user.user_id]],
+            [latest_tied.message_id]
+        )
+        chats = PrivateChat.get_latest_for_partners(
+            db, user.user_id, partner_ids, 5
+        )
+        self.assertEqual(
+            [message.message_id for message in chats[another_user.user_id]],
+            [latest_received.message_id, first.message_id]
+        )
+        self.assertEqual(
+            [message.message_id for message in chats[third_user.user_id]],
+            [latest_tied.message_id, sent.message_id]
+        )
+
+    def test_first_messages_from_both_sides(self):
+        user = self.ensure_register()
+        another_user = self.ensure_register()
+        engine = inject.instance('db_engine')
+        now = datetime.utcnow()
+        errors = []
+
+        def send(db, sender, receiver, sent_at):
+            message = PrivateChat.add(
+                db, self.generator.uuid.generate(), receiver.user_id,
+                sender.user_id, self.generator.text.generate(), None, sent_at
+            )
+            _ = Conversation.add_message(db, message)
+            return message
+
+        def send_and_commit(sender, receiver, sent_at):
+            db = Session(bind=engine)
+            try:
+                _ = send(db, sender, receiver, sent_at)
+                commit(db)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.close()
+        db = Session(bind=engine)
+        first = send(db, user, another_user, now)
+        # Waits for the rows the first, uncommitted send inserted
+        thread = Thread(
+            target=send_and_commit,
+            args=(another_user, user, now - timedelta(seconds=1))
+        )
+        thread.start()
+        thread.join(0.5)
+        commit(db)
+        db.close()
+        thread.join()
+        self.assertEqual(errors, [])
+        db = inject.instance('db')
+        for user_id, partner_id in [
+            (user.user_id, another_user.user_id),
+            (another_user.user_id, user.user_id)
+        ]:
+            conversation = Conversation.get(db, user_id, partner_id)
+            self.assertEqual(conversation.count, 2)
+            # Earlier message committed later is not the last one
+            self.assertEqual(conversation.last_message_id, first.message_id)
+            self.assertEqual(conversation.last_sent_at, now)
+
+
+class TestMetrics(BaseAsyncHTTPTestCase):
+    def get_app(self):
+        return letsfuk.make_metrics_app()
+
+    def test_metrics(self):
+        response = self.fetch('/metrics', method="GET")
+        self.assertEqual(response.code, 200)
+        response_body = json.loads(response.body.decode())
+        self.assertIn('delivery', response_body)
+        self.assertIn('websockets', response_body)
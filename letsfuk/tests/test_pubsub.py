@@ -0,0 +1,52 @@
+import inject
+from tornado import gen
+from tornado.testing import gen_test
+
+from letsfuk.pubsub import MemoryPubSub, PostgresPubSub
+from letsfuk.tests import BaseAsyncHTTPTestCase
+
+
+class TestPubSub(BaseAsyncHTTPTestCase):
+    def test_memory_publish(self):
+        pubsub = MemoryPubSub()
+        received = []
+        pubsub.subscribe('channel', received.append)
+        pubsub.publish('channel', 'payload')
+        pubsub.publish('another_channel', 'another_payload')
+        self.assertEqual(received, ['payload'])
+
+    @gen_test
+    async def test_postgres_publish_reaches_other_process(self):
+        engine = inject.instance('db_engine')
+        publisher = PostgresPubSub(engine)
+        listener = PostgresPubSub(engine)
+        received = []
+        listener.subscribe('channel', received.append)
+        listener.start()
+        publisher.publish('channel', 'payload')
+        publisher.publish('channel', 'another_payload')
+        await self.wait_for_received(received, 2)
+        self.assertEqual(received, ['payload', 'another_payload'])
+        for pubsub in [publisher, listener]:
+            pubsub.stop()
+
+    @gen_test
+    async def test_postgres_listen_again_after_connection_lost(self):
+        engine = inject.instance('db_engine')
+        publisher = PostgresPubSub(engine)
+        listener = PostgresPubSub(engine)
+        listener.reconnect_delay = 0.05
+        received = []
+        listener.subscribe('channel', received.append)
+        listener.start()
+        lost_connection = listener.connection
+        lost_connection.close()
+        listener.on_notify(listener.fd, None)
+        await gen.sleep(0.2)
+        self.assertIsNotNone(listener.connection)
+        self.assertIsNot(listener.connection, lost_connection)
+        publisher.publish('channel', 'payload')
+        await self.wait_for_received(received, 1)
+        self.assertEqual(received, ['payload'])
+        listener.stop()
+
@@ -1,7 +1,50 @@
+import base64
 import json
+import os
+
+import inject
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, PublicFormat
+)
+from sqlalchemy import event
+from tornado import gen
+from tornado.testing import gen_test
+from tornado.web import RequestHandler
+
+import letsfuk
+from letsfuk import Config
+from letsfuk.db import transaction
+from letsfuk.db.models import PushNotification
+from letsfuk.delivery import DeliveryQueue
+from letsfuk.models.push_notifications import (
+    PushNotifications, PushTransport, PushCoalescer
+)
 from letsfuk.tests import BaseAsyncHTTPTestCase
 
 
+def b64url(value):
+    return base64.urlsafe_b64encode(value).rstrip(b'=').decode()
+
+
+def generate_private_key():
+    return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+
+class PushServiceStandIn(RequestHandler):
+    """Plays push service, answers with queued status codes."""
+    status_codes = []
+    received = []
+
+    def post(self):
+        self.received.append(self.request.body)
+        status_code = 201
+        if len(self.status_codes) > 0:
+            status_code = self.status_codes.pop(0)
+        self.set_status(status_code)
+
+
 class TestPushNotifications(BaseAsyncHTTPTestCase):
     def test_subscribe(self):
         session, user = self.ensure_login()
@@ -118,3 +161,257 @@ class TestPushNotifications(BaseAsyncHTTPTestCase):
         self.assertEqual(endpoint, response_endpoint)
         self.assertEqual(auth, response_auth)
         self.assertEqual(p256dh, response_p256dh)
+
+
+class TestPushDelivery(BaseAsyncHTTPTestCase):
+    config_keys = [
+        'vapid_private_key', 'vapid_mail', 'push_retry_backoff',
+        'push_digest_window', 'push_ack_timeout'
+    ]
+
+    def setUp(self):
+        super(TestPushDelivery, self).setUp()
+        PushServiceStandIn.status_codes = []
+        PushServiceStandIn.received = []
+        config = inject.instance(Config)
+        vapid_key = generate_private_key()
+        private_value = vapid_key.private_numbers().private_value
+        config.data['vapid_private_key'] = b64url(
+            private_value.to_bytes(32, 'big')
+        )
+        config.data['vapid_mail'] = 'push@letsfuk.com'
+        config.data['push_retry_backoff'] = 0
+        config.data['push_digest_window'] = 0.2
+        config.data['push_ack_timeout'] = None
+
+    def get_app(self):
+        app = letsfuk.make_app()
+        app.add_handlers(r'.*', [('/push-service/?', PushServiceStandIn)])
+        return app
+
+    def ensure_device_browser(self):
+        public_key = generate_private_key().public_key().public_bytes(
+            Encoding.X962, PublicFormat.UncompressedPoint
+        )
+        subscriber, _, _ = self.ensure_push_sub(
+            endpoint=self.get_url('/push-service'),
+            auth=b64url(os.urandom(16)),
+            p256dh=b64url(public_key)
+        )
+        return subscriber
+
+    def assertSubscribed(self, subscriber, subscribed):
+        db = inject.instance('db')
+        device_browser = PushNotification.query_by_device_browser(
+            db, subscriber.endpoint, subscriber.auth, subscriber.p256dh
+        )
+        if subscribed:
+            self.assertIsNotNone(device_browser)
+        else:
+            self.assertIsNone(device_browser)
+
+    async def send(self, subscriber):
+        subscription_info = PushNotifications.get_subscription_info(
+            subscriber
+        )
+        sent = await PushNotifications.send(subscription_info, {"text": "Hi"})
+        return sent
+
+    @gen_test
+    async def test_send(self):
+        subscriber = self.ensure_device_browser()
+        sent = await self.send(subscriber)
+        self.assertTrue(sent)
+        self.assertEqual(len(PushServiceStandIn.received), 1)
+        self.assertSubscribed(subscriber, True)
+
+    @gen_test
+    async def test_send_retries_unavailable(self):
+        subscriber = self.ensure_device_browser()
+        PushServiceStandIn.status_codes = [503, 429]
+        sent = await self.send(subscriber)
+        self.assertTrue(sent)
+        self.assertEqual(len(PushServiceStandIn.received), 3)
+
+    @gen_test
+    async def test_send_gone_unsubscribes(self):
+        subscriber = self.ensure_device_browser()
+        PushServiceStandIn.status_codes = [410]
+        sent = await self.send(subscriber)
+        self.assertFalse(sent)
+        self.assertEqual(len(PushServiceStandIn.received), 1)
+        self.assertSubscribed(subscriber, False)
+
+    @gen_test
+    async def test_send_bad_request_not_retried(self):
+        subscriber = self.ensure_device_browser()
+        PushServiceStandIn.status_codes = [400]
+        sent = await self.send(subscriber)
+        self.assertFalse(sent)
+        self.assertEqual(len(PushServiceStandIn.received), 1)
+        self.assertSubscribed(subscriber, True)
+
+    @gen_test
+    async def test_send_reuses_session_and_vapid_headers(self):
+        subscriber = self.ensure_device_browser()
+        another_subscriber = self.ensure_device_browser()
+        sent = await self.send(subscriber)
+        self.assertTrue(sent)
+        origin = PushTransport.get_origin(subscriber.endpoint)
+        session = PushTransport.sessions[origin]
+        _, headers = PushTransport.vapid_headers[(
+            origin, 'mailto:push@letsfuk.com'
+        )]
+        sent = await self.send(another_subscriber)
+        self.assertTrue(sent)
+        self.assertIs(PushTransport.sessions[origin], session)
+        self.assertIs(PushTransport.vapid_headers[(
+            origin, 'mailto:push@letsfuk.com'
+        )][1], headers)
+        self.assertEqual(len(PushServiceStandIn.received), 2)
+
+    @gen_test
+    async def test_send_to_user_after_subscription_deleted(self):
+        subscriber = self.ensure_device_browser()
+        db = inject.instance('db')
+        with transaction(db):
+            PushNotifications.send_to_user(subscriber.user_id, {"text": "Hi"})
+            # Gone before the spawned send got to run
+            PushNotification.unsubscribe(db, subscriber)
+        await self.wait_for_received(PushServiceStandIn.received, 1)
+        self.assertEqual(len(PushServiceStandIn.received), 1)
+
+    @gen_test
+    async def test_coalesce_pushes_into_digest(self):
+        subscriber = self.ensure_device_browser()
+        for i in range(3):
+            PushCoalescer.add(subscriber.user_id, {"text": str(i)})
+        # First one goes out right away, the rest wait for the window
+        await self.wait_for_received(PushServiceStandIn.received, 1)
+        self.assertEqual(len(PushServiceStandIn.received), 1)
+        await self.wait_for_received(PushServiceStandIn.received, 2)
+        self.assertEqual(len(PushServiceStandIn.received), 2)
+        await gen.sleep(0.5)
+        self.assertEqual(len(PushServiceStandIn.received), 2)
+        self.assertNotIn(subscriber.user_id, PushCoalescer.pending)
+
+    @gen_test
+    async def test_pushes_load_subscriptions_once(self):
+        subscribers = [self.ensure_device_browser() for _ in range(3)]
+        engine = inject.instance('db_engine')
+        statements = []
+
+        def on_execute(conn, cursor, statement, parameters, context, many):
+            if 'FROM push_notifications' in statement:
+                statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', on_execute)
+        try:
+            # Like a station message fanned out to its members
+            for subscriber in subscribers:
+                PushCoalescer.add(subscriber.user_id, {"text": "Hi"})
+            await self.wait_for_received(PushServiceStandIn.received, 3)
+        finally:
+            event.remove(engine, 'before_cursor_execute', on_execute)
+        self.assertEqual(len(PushServiceStandIn.received), 3)
+        self.assertEqual(len(statements), 1)
+
+    def test_make_digest(self):
+        single = {"is_station": False, "text": "Hi"}
+        self.assertIs(PushCoalescer.make_digest([single]), single)
+        held = [
+            {"is_station": False, "sender": {"user_id": "a"}},
+            {"is_station": False, "sender": {"user_id": "a"}},
+            {"is_station": False, "sender": {"user_id": "b"}},
+            {"is_station": True, "receiver_id": "s"},
+            {"is_station": True, "receiver_id": "s"}
+        ]
+        digest = PushCoalescer.make_digest(held)
+        self.assertTrue(digest.get('is_digest'))
+        self.assertEqual(digest.get('messages'), 5)
+        self.assertEqual(digest.get('chats'), 3)
+        self.assertEqual(digest.get('text'), "5 new messages from 3 chats")
+
+    @gen_test
+    async def test_push_when_offline(self):
+        subscriber = self.ensure_device_browser()
+        DeliveryQueue.enqueue(
+            subscriber.user_id, data={"text": "Hi"}, push=True
+        )
+        await self.wait_for_received(PushServiceStandIn.received, 1)
+        self.assertEqual(len(PushServiceStandIn.received), 1)
+
+    @gen_test
+    async def test_no_push_when_online(self):
+        subscriber = self.ensure_device_browser()
+        web_socket = await self.connect(subscriber.user_id)
+        DeliveryQueue.enqueue(
+            subscriber.user_id, data={"text": "Hi"}, push=True
+        )
+        message = json.loads(await web_socket.read_message())
+        self.assertEqual(message.get('data').get('text'), "Hi")
+        await gen.sleep(0.3)
+        self.assertEqual(len(PushServiceStandIn.received), 0)
+        web_socket.close()
+
+    @gen_test
+    async def test_no_push_when_acked(self):
+        inject.instance(Config).data['push_ack_timeout'] = 0.2
+        subscriber = self.ensure_device_browser()
+        web_socket = await self.connect(subscriber.user_id, acks=True)
+        DeliveryQueue.enqueue(
+            subscriber.user_id, data={"text": "Hi"}, push=True
+        )
+        message = json.loads(await web_socket.read_message())
+        delivery_id = message.get('data').get('delivery_id')
+        self.assertIsNotNone(delivery_id)
+        web_socket.write_message(json.dumps({
+            "event": "ack",
+            "data": {"delivery_id": delivery_id}
+        }))
+        await gen.sleep(0.5)
+        self.assertEqual(len(PushServiceStandIn.received), 0)
+        web_socket.close()
+
+    @gen_test
+    async def test_push_when_not_acked(self):
+        inject.instance(Config).data['push_ack_timeout'] = 0.2
+        subscriber = self.ensure_device_browser()
+        web_socket = await self.connect(subscriber.user_id, acks=True)
+        DeliveryQueue.enqueue(
+            subscriber.user_id, data={"text": "Hi"}, push=True
+        )
+        _ = await web_socket.read_message()
+        await self.wait_for_received(PushServiceStandIn.received, 1)
+        self.assertEqual(len(PushServiceStandIn.received), 1)
+        web_socket.close()
+
+    @gen_test
+    async def test_no_push_when_client_does_not_ack(self):
+        inject.instance(Config).data['push_ack_timeout'] = 0.2
+        subscriber = self.ensure_device_browser()
+        web_socket = await self.connect(subscriber.user_id)
+        DeliveryQueue.enqueue(
+            subscriber.user_id, data={"text": "Hi"}, push=True
+        )
+        _ = await web_socket.read_message()
+        await gen.sleep(0.5)
+        self.assertEqual(len(PushServiceStandIn.received), 0)
+        web_socket.close()
+
+    @gen_test
+    async def test_published_delivery_waits_for_ack(self):
+        inject.instance(Config).data['push_ack_timeout'] = 0.2
+        pubsub = inject.instance('pubsub')
+        # Device may be connected to another process, nobody here
+        pubsub.cross_process = True
+        try:
+            subscriber = self.ensure_device_browser()
+            DeliveryQueue.enqueue(
+                subscriber.user_id, data={"text": "Hi"}, push=True
+            )
+            await gen.sleep(0.1)
+            self.assertEqual(len(PushServiceStandIn.received), 0)
+            await self.wait_for_received(PushServiceStandIn.received, 1)
+            self.assertEqual(len(PushServiceStandIn.received), 1)
+        finally:
+            del pubsub.cross_process
@@ -0,0 +1,70 @@
+import inject
+from sqlalchemy import text
+
+from letsfuk.tests import BaseAsyncHTTPTestCase
+
+
+class TestQueryPlans(BaseAsyncHTTPTestCase):
+    def explain(self, query, **params):
+        db = inject.instance('db')
+        # Test tables are tiny so planner would pick sequential scans,
+        # turn them off to check that an index can serve the query at all
+        db.execute(text('SET LOCAL enable_seqscan = off'))
+        rows = db.execute(text('EXPLAIN {}'.format(query)), params).fetchall()
+        db.rollback()
+        plan = '\n'.join(row[0] for row in rows)
+        return plan
+
+    def assertIndexScan(self, plan, table):
+        self.assertNotIn('Seq Scan on {}'.format(table), plan)
+        self.assertIn('Index', plan)
+
+    def test_station_chat_uses_index(self):
+        station = self.add_station()
+        _ = self.make_station_chat(station)
+        plan = self.explain(
+            'SELECT * FROM station_chats '
+            'WHERE receiver_id = :receiver_id '
+            'ORDER BY sent_at DESC, id DESC LIMIT 20',
+            receiver_id=station.station_id
+        )
+        self.assertIndexScan(plan, 'station_chats')
+        self.assertNotIn('Sort', plan)
+
+    def test_private_chat_uses_index(self):
+        station = self.add_station()
+        _, user = self.ensure_login(station=station)
+        _, another_user = self.ensure_login(station=station)
+        _ = self.make_private_chat(user, another_user)
+        plan = self.explain(
+            'SELECT * FROM private_chats '
+            'WHERE (receiver_id = :receiver_id AND sender_id = :sender_id) '
+            'OR (receiver_id = :sender_id AND sender_id = :receiver_id) '
+            'ORDER BY sent_at DESC, id DESC LIMIT 20',
+            receiver_id=another_user.user_id, sender_id=user.user_id
+        )
+        self.assertIndexScan(plan, 'private_chats')
+
+    def test_station_members_use_index(self):
+        station = self.add_station()
+        _ = self.make_station_chat(station)
+        plan = self.explain(
+            'SELECT user_id FROM subscribers '
+            'WHERE station_id = :station_id',
+            station_id=station.station_id
+        )
+        self.assertIndexScan(plan, 'subscribers')
+
+    def test_inbox_uses_index(self):
+        station = self.add_station()
+        _, user = self.ensure_login(station=station)
+        _, another_user = self.ensure_login(station=station)
+        _ = self.make_private_chat(user, another_user)
+        plan = self.explain(
+            'SELECT partner_id FROM conversations '
+            'WHERE user_id = :user_id '
+            'ORDER BY last_sent_at DESC LIMIT 20',
+            user_id=user.user_id
+        )
+        self.assertIndexScan(plan, 'conversations')
+        self.assertNotIn('Sort', plan)
@@ -1,4 +1,8 @@
 import json
+
+import inject
+
+from letsfuk.db.models import ReadPointer
 from letsfuk.tests import BaseAsyncHTTPTestCase
 
 
@@ -97,6 +101,29 @@ class TestStations(BaseAsyncHTTPTestCase):
         self.assertEqual(station.station_id, response_body.get('station_id'))
         self.assertEqual(user.user_id, response_body.get('user_id'))
 
+    def test_subscribe_history_not_unread(self):
+        stations = self.ensure_stations()
+        session, user = self.ensure_login(station=stations[0])
+        lat = self.generator.latitude.generate()
+        lon = self.generator.longitude.generate()
+        station = self.closest_station(stations, lat, lon)
+        another_user = self.ensure_register(station=station)
+        _ = self.add_group_message(another_user.user_id, station.station_id)
+        response = self.fetch(
+            '/stations/subscribe',
+            method="POST",
+            body=json.dumps({"lat": lat, "lon": lon}).encode('utf-8'),
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        db = inject.instance('db')
+        count = ReadPointer.count_unread(
+            db, user.user_id, station.station_id, 99
+        )
+        self.assertEqual(count, 0)
+
     def test_subscribe_invalid_lat_and_lon(self):
         session, user = self.ensure_login()
         session_id = session.session_id
@@ -152,3 +179,32 @@ class TestStations(BaseAsyncHTTPTestCase):
         )
         self.assertEqual(len(response_members), 3)
 
+    def test_get_station_after_member_joined(self):
+        station = self.add_station()
+        session, _ = self.ensure_login(station=station)
+        response = self.fetch(
+            '/stations/{}'.format(station.station_id),
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        response_body = json.loads(response.body.decode())
+        self.assertEqual(len(response_body.get('members')), 1)
+        _, user = self.ensure_login(station=station)
+        response = self.fetch(
+            '/stations/{}'.format(station.station_id),
+            method="GET",
+            headers={
+                "session-id": session.session_id
+            }
+        )
+        self.assertEqual(response.code, 200)
+        response_body = json.loads(response.body.decode())
+        response_members = response_body.get('members')
+        self.assertEqual(len(response_members), 2)
+        self.assertIn(
+            user.user_id,
+            [member.get('user_id') for member in response_members]
+        )
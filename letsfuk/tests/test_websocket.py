@@ -0,0 +1,227 @@
+import json
+import time
+
+import inject
+from tornado import gen
+from tornado.testing import gen_test
+from tornado.websocket import websocket_connect
+
+from letsfuk import Config
+from letsfuk.delivery import DeliveryQueue
+from letsfuk.handlers.websocket import MessageWebSocketHandler
+from letsfuk.tests import BaseAsyncHTTPTestCase
+
+
+class TestWebSocket(BaseAsyncHTTPTestCase):
+    config_keys = [
+        'websocket_high_water', 'websocket_slow_timeout',
+        'websocket_hard_limit', 'websocket_connect_timeout',
+        'websocket_idle_timeout'
+    ]
+
+    def get_server_socket(self, user_id):
+        server_sockets = MessageWebSocketHandler.live_web_sockets.get(user_id)
+        self.assertEqual(len(server_sockets), 1)
+        return server_sockets[0]
+
+    @gen_test
+    async def test_pending_frames_coalesced(self):
+        user = self.ensure_register()
+        web_socket = await self.connect(user.user_id)
+        server_socket = self.get_server_socket(user.user_id)
+        # Nothing is written until the IOLoop gets control back
+        for count in range(2):
+            MessageWebSocketHandler.send_message(
+                user.user_id, event='unread', data={"count": count},
+                coalesce_key='unread:station'
+            )
+        MessageWebSocketHandler.send_message(
+            user.user_id, event='message', data={"text": "Hi"}
+        )
+        MessageWebSocketHandler.send_message(
+            user.user_id, event='unread', data={"count": 2},
+            coalesce_key='unread:station'
+        )
+        self.assertEqual(len(server_socket.outbox), 2)
+        # Latest count goes after the message queued before it
+        message = json.loads(await web_socket.read_message())
+        self.assertEqual(message.get('data').get('text'), "Hi")
+        message = json.loads(await web_socket.read_message())
+        self.assertEqual(message.get('event'), 'unread')
+        self.assertEqual(message.get('data').get('count'), 2)
+        await gen.sleep(0.05)
+        self.assertEqual(server_socket.buffered, 0)
+        web_socket.close()
+
+    @gen_test
+    async def test_sweep_closes_stalled_consumer(self):
+        config = inject.instance(Config)
+        config.data['websocket_high_water'] = 10
+        config.data['websocket_slow_timeout'] = 1
+        user = self.ensure_register()
+        web_socket = await self.connect(user.user_id)
+        server_socket = self.get_server_socket(user.user_id)
+        # Pretend a write has been stuck for a while, no new frames come
+        server_socket.buffered = 100
+        server_socket.over_high_water_since = time.monotonic() - 2
+        MessageWebSocketHandler.sweep()
+        self.assertNotIn(
+            user.user_id, MessageWebSocketHandler.live_web_sockets
+        )
+        message = await gen.with_timeout(
+            self.io_loop.time() + 2, web_socket.read_message()
+        )
+        self.assertIsNone(message)
+
+    @gen_test
+    async def test_slow_consumer_closed(self):
+        config = inject.instance(Config)
+        config.data['websocket_high_water'] = 10
+        config.data['websocket_slow_timeout'] = 0
+        user = self.ensure_register()
+        web_socket = await self.connect(user.user_id)
+        server_socket = self.get_server_socket(user.user_id)
+        sent = MessageWebSocketHandler.send_message(
+            user.user_id, data={"text": "Over high water mark"}
+        )
+        self.assertTrue(sent)
+        # Block the IOLoop so the first frame is still pending
+        time.sleep(0.01)
+        sent = MessageWebSocketHandler.send_message(
+            user.user_id, data={"text": "Still over it"}
+        )
+        self.assertFalse(sent)
+        self.assertNotIn(
+            user.user_id, MessageWebSocketHandler.live_web_sockets
+        )
+        self.assertFalse(server_socket.queue_frame('{}'))
+        metrics = MessageWebSocketHandler.metrics()
+        self.assertGreaterEqual(metrics.get('slow_consumers_closed'), 1)
+        web_socket.close()
+
+    @gen_test
+    async def test_flooded_consumer_closed_over_hard_limit(self):
+        config = inject.instance(Config)
+        config.data['websocket_high_water'] = 1000
+        config.data['websocket_hard_limit'] = 4000
+        config.data['websocket_slow_timeout'] = 60
+        user = self.ensure_register()
+        web_socket = await self.connect(user.user_id)
+        server_socket = self.get_server_socket(user.user_id)
+        # Client reads nothing and IOLoop gets no chance to write
+        text = "x" * 100
+        sent = [
+            MessageWebSocketHandler.send_message(
+                user.user_id, data={"text": text}
+            )
+            for _ in range(100)
+        ]
+        self.assertIn(False, sent)
+        self.assertLess(sent.index(False), 50)
+        self.assertNotIn(
+            user.user_id, MessageWebSocketHandler.live_web_sockets
+        )
+        self.assertFalse(server_socket.queue_frame('{}'))
+        web_socket.close()
+
+    @gen_test
+    async def test_closed_without_connect_event(self):
+        config = inject.instance(Config)
+        config.data['websocket_connect_timeout'] = 0.1
+        url = self.get_url('/websocket').replace('http', 'ws', 1)
+        web_socket = await websocket_connect(url)
+        message = await gen.with_timeout(
+            self.io_loop.time() + 2, web_socket.read_message()
+        )
+        # None means server closed the connection
+        self.assertIsNone(message)
+
+    @gen_test
+    async def test_sweep_evicts_idle_sockets(self):
+        config = inject.instance(Config)
+        config.data['websocket_idle_timeout'] = 60
+        user = self.ensure_register()
+        idle_user = self.ensure_register()
+        web_socket = await self.connect(user.user_id)
+        idle_web_socket = await self.connect(idle_user.user_id)
+        idle_server_socket = self.get_server_socket(idle_user.user_id)
+        # Pretend nothing was heard since long ago, not even a pong
+        idle_server_socket.last_seen -= 120
+        MessageWebSocketHandler.sweep()
+        registry = MessageWebSocketHandler.live_web_sockets
+        self.assertIn(user.user_id, registry)
+        self.assertNotIn(idle_user.user_id, registry)
+        message = await gen.with_timeout(
+            self.io_loop.time() + 2, idle_web_socket.read_message()
+        )
+        self.assertIsNone(message)
+        web_socket.close()
+
+    def test_payloads_split_under_limit(self):
+        recipients = {
+            str(user_id): {"unread": user_id} for user_id in range(100)
+        }
+        data = {"text": "Hi"}
+        payloads = MessageWebSocketHandler.make_payloads(
+            'message', data, recipients, None, 1000
+        )
+        self.assertGreater(len(payloads), 1)
+        published = dict()
+        for payload, user_ids in payloads:
+            self.assertLessEqual(len(payload.encode()), 1000)
+            message = json.loads(payload)
+            self.assertEqual(message.get('data'), data)
+            self.assertEqual(set(message.get('recipients')), set(user_ids))
+            published.update(message.get('recipients'))
+        self.assertEqual(published, recipients)
+        payloads = MessageWebSocketHandler.make_payloads(
+            'message', {"text": "Hi" * 1000}, {"user_id": None}, None, 1000
+        )
+        self.assertEqual(payloads, [])
+
+    @gen_test
+    async def test_published_frame_reaches_local_devices(self):
+        user = self.ensure_register()
+        another_user = self.ensure_register()
+        web_socket = await self.connect(user.user_id)
+        another_web_socket = await self.connect(another_user.user_id)
+        # Comes from another process, one payload for both recipients
+        MessageWebSocketHandler.on_published_message(json.dumps({
+            "process_id": "another_process",
+            "id": 0,
+            "event": "message",
+            "data": {"text": "Hi"},
+            "coalesce_key": None,
+            "recipients": {
+                user.user_id: {"unread": 1},
+                another_user.user_id: {"unread": 2}
+            }
+        }))
+        for client, unread in [(web_socket, 1), (another_web_socket, 2)]:
+            message = json.loads(await client.read_message())
+            self.assertEqual(message.get('event'), 'message')
+            self.assertEqual(
+                message.get('data'), {"text": "Hi", "unread": unread}
+            )
+            client.close()
+
+    @gen_test
+    async def test_deliver_to_every_device(self):
+        user = self.ensure_register()
+        registry = MessageWebSocketHandler.live_web_sockets
+        phone = await self.connect(user.user_id)
+        laptop = await self.connect(user.user_id)
+        self.assertEqual(len(registry.get(user.user_id)), 2)
+        DeliveryQueue.enqueue(user.user_id, data={"text": "Hi"})
+        for web_socket in [phone, laptop]:
+            message = json.loads(await web_socket.read_message())
+            self.assertEqual(message.get('data').get('text'), "Hi")
+        phone.close()
+        await gen.sleep(0.1)
+        self.assertEqual(len(registry.get(user.user_id)), 1)
+        DeliveryQueue.enqueue(user.user_id, data={"text": "Bye"})
+        message = json.loads(await laptop.read_message())
+        self.assertEqual(message.get('data').get('text'), "Bye")
+        laptop.close()
+        await gen.sleep(0.1)
+        self.assertNotIn(user.user_id, registry)